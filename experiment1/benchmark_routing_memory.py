@@ -0,0 +1,74 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script measures the time per training step and the peak memory of the
+training process with or without recomputing the routing during backprop
+(see parameters.py: routing_recompute). Since the peak memory is measured
+for the whole process, run the script once for each mode, e.g.:
+    python benchmark_routing_memory.py --routing_recompute=False
+    python benchmark_routing_memory.py --routing_recompute=True
+The results are appended to routing_memory_benchmark.txt in the logdir.
+The datasets have to be created first (see make_tfrecords.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import os
+import resource
+import time
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import capser_model_fn
+from capser_input_fn import train_input_fn
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting routing memory benchmark...')
+print('Recompute routing:', parameters.routing_recompute)
+print('-------------------------------------------------------')
+
+
+###########################
+#       Main script:      #
+###########################
+n_steps = 100
+n_warmup_steps = 10
+log_dir = parameters.logdir + 'routing_memory_benchmark/'
+
+tf.reset_default_graph()
+tf.train.create_global_step()
+features, _ = train_input_fn()
+spec = capser_model_fn(features, None, tf.estimator.ModeKeys.TRAIN,
+                       params={'log_dir': log_dir})
+
+with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    for i in range(n_warmup_steps):
+        sess.run(spec.train_op)
+
+    start = time.time()
+    for i in range(n_steps):
+        sess.run(spec.train_op)
+    step_time = (time.time() - start) / n_steps
+
+# On Linux, ru_maxrss is given in kilobytes
+peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+report = ('routing_recompute: ' + str(parameters.routing_recompute) + '; batch_size: ' + str(parameters.batch_size) +
+          '; iter_routing: ' + str(parameters.iter_routing) +
+          '; time per step: %.1fms; peak memory: %.1fMB' % (step_time*1000, peak_memory))
+print('-------------------------------------------------------')
+print(report)
+
+if not os.path.exists(parameters.logdir):
+    os.mkdir(parameters.logdir)
+with open(parameters.logdir + '/routing_memory_benchmark.txt', 'a') as f:
+    f.write(report + '\n')
+
+
+print('... Finished routing memory benchmark!')
+print('-------------------------------------------------------')
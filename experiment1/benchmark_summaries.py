@@ -0,0 +1,92 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script measures the overhead of the tensorboard summaries during
+training for each summary level (see parameters.py: summary_level). For each
+level, the summaries are written every summary_steps steps (as during
+training with the estimator) and the time per training step is compared to
+the time per training step without any summaries.
+The datasets have to be created first (see make_tfrecords.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import os
+import time
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import capser_model_fn, cnn_model_fn
+from capser_input_fn import train_input_fn
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting summary benchmark...')
+print('-------------------------------------------------------')
+
+
+###########################
+#      Preparations:      #
+###########################
+summary_levels = ['off', 'scalars', 'full']
+n_steps = 200
+n_warmup_steps = 10
+
+# Same frequency as the estimator's default summary hook:
+summary_steps = 100
+
+model_fn = capser_model_fn if parameters.net_type.lower() == 'capsnet' else cnn_model_fn
+log_dir = parameters.logdir + 'summary_benchmark/'
+step_times = {}
+
+
+###########################
+#       Main script:      #
+###########################
+for summary_level in summary_levels:
+    parameters.summary_level = summary_level
+
+    tf.reset_default_graph()
+    tf.train.create_global_step()
+    features, _ = train_input_fn()
+    spec = model_fn(features, None, tf.estimator.ModeKeys.TRAIN, params={'log_dir': log_dir})
+    summary_op = tf.summary.merge_all()
+    n_summaries = len(tf.get_collection(tf.GraphKeys.SUMMARIES))
+
+    with tf.Session() as sess:
+        writer = tf.summary.FileWriter(log_dir + summary_level)
+        sess.run(tf.global_variables_initializer())
+        for i in range(n_warmup_steps):
+            sess.run(spec.train_op)
+
+        start = time.time()
+        for i in range(n_steps):
+            if summary_op is not None and i % summary_steps == 0:
+                _, summary = sess.run([spec.train_op, summary_op])
+                writer.add_summary(summary, i)
+            else:
+                sess.run(spec.train_op)
+        step_times[summary_level] = (time.time() - start) / n_steps
+        writer.close()
+
+    print('-------------------------------------------------------')
+    print('summary_level: ' + summary_level + '; summaries: ' + str(n_summaries) +
+          '; time per step: %.2fms' % (step_times[summary_level]*1000))
+
+if not os.path.exists(parameters.logdir):
+    os.mkdir(parameters.logdir)
+with open(parameters.logdir + '/summary_benchmark.txt', 'w') as f:
+    for summary_level in summary_levels:
+        report = ('summary_level: ' + summary_level + '; summary_steps: ' + str(summary_steps) +
+                  '; time per step: %.2fms; overhead: %.2fms (%.1f%%)'
+                  % (step_times[summary_level]*1000, (step_times[summary_level] - step_times['off'])*1000,
+                     (step_times[summary_level] / step_times['off'] - 1) * 100))
+        print(report)
+        f.write(report + '\n')
+
+
+print('... Finished summary benchmark!')
+print('-------------------------------------------------------')
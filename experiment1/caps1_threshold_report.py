@@ -0,0 +1,93 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script tests the trained capsule networks with different thresholds for
+skipping inactive primary capsules in the routing (see parameters.py:
+caps1_threshold) and reports the vernier accuracies and prediction times, so
+that the speedup can be traded off against the deviation in performance.
+The networks have to be trained first (see capser_main.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import logging
+import time
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import capser_model_fn
+from capser_input_fn import predict_crowding_input_fn
+from capser_functions import group_crowding_predictions
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting caps1_threshold report...')
+print('-------------------------------------------------------')
+
+
+###########################
+#      Preparations:      #
+###########################
+# Thresholds for the primary capsule output norms (0 = no capsules skipped):
+thresholds = [0., 0.01, 0.02, 0.05, 0.1, 0.2]
+
+n_iterations = parameters.n_iterations
+n_idx = parameters.n_idx
+n_categories = len(parameters.test_crowding_data_paths)
+
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
+# Initialize results
+results = np.zeros(shape=(len(thresholds), n_categories, n_idx, n_iterations))
+durations = np.zeros(shape=(len(thresholds), n_iterations))
+
+# Lets have less logs:
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+###########################
+#       Main script:      #
+###########################
+for idx_threshold, threshold in enumerate(thresholds):
+    parameters.caps1_threshold = threshold
+    for idx_execution in range(n_iterations):
+        log_dir = parameters.logdir + str(idx_execution) + '/'
+        capser = tf.estimator.Estimator(model_fn=capser_model_fn, model_dir=log_dir,
+                                        params={'log_dir': log_dir})
+
+        start = time.time()
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy, _, _, _ = group_crowding_predictions(capser_out, n_categories, n_idx)
+        durations[idx_threshold, idx_execution] = time.time() - start
+        results[idx_threshold, :, :, idx_execution] = vernier_accuracy
+
+
+# Compare everything to the results without skipping any capsules:
+mean_results = np.mean(results, axis=-1)
+mean_durations = np.mean(durations, axis=-1)
+txt_file_name = parameters.logdir + '/caps1_threshold_report.txt'
+with open(txt_file_name, 'w') as f:
+    for idx_threshold, threshold in enumerate(thresholds):
+        deviation = mean_results[idx_threshold] - mean_results[0]
+        report = ('caps1_threshold: ' + str(threshold) +
+                  '; time: %.1fs; speedup: %.2f; mean abs deviation: %.4f; max abs deviation: %.4f\n'
+                  % (mean_durations[idx_threshold], mean_durations[0] / mean_durations[idx_threshold],
+                     np.mean(np.abs(deviation)), np.max(np.abs(deviation))))
+        for n_category in range(n_categories):
+            category = parameters.test_crowding_data_paths[n_category]
+            report += category + ' : \t' + str(mean_results[idx_threshold, n_category, :]) + \
+            ' : \t' + str(deviation[n_category, :]) + '\n'
+
+        print('-------------------------------------------------------')
+        print(report)
+        f.write(report + '\n')
+
+
+print('... Finished caps1_threshold report!')
+print('-------------------------------------------------------')
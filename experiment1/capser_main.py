@@ -15,14 +15,10 @@ import tensorflow as tf
 import os
 import re
 
-# Optional: use Beholder to check on weights during training in tensorboard
-from tensorboard.plugins.beholder import Beholder
-from tensorboard.plugins.beholder import BeholderHook
-
 from parameters import parameters
 from capser_model_fn import capser_model_fn, cnn_model_fn
-from capser_input_fn import train_input_fn, eval_input_fn, predict_input_fn
-from capser_functions import save_params, plot_uncrowding_results
+from capser_input_fn import train_input_fn, eval_input_fn, predict_crowding_input_fn
+from capser_functions import save_params, plot_uncrowding_results, group_crowding_predictions
 
 
 print('-------------------------------------------------------')
@@ -74,6 +70,10 @@ n_categories = len(parameters.test_crowding_data_paths)
 # Initialize results
 results = np.zeros(shape=(n_categories, n_idx, n_iterations))
 
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
 
 ###########################
 #       Main script:      #
@@ -88,12 +88,11 @@ for idx_execution in range(n_iterations):
     # Output the loss in the terminal every few steps:
     logging.getLogger().setLevel(logging.INFO)
 
-    # Optional: use Beholder to check on weights during training in tensorboard
-    beholder = Beholder(log_dir)
-    beholder_hook = BeholderHook(log_dir)
-
-    # Create the estimator (Retain the 2 most recent checkpoints)
-    checkpointing_config = tf.estimator.RunConfig(keep_checkpoint_max=2)
+    # Create the estimator (Retain the 2 most recent checkpoints). Without
+    # summaries (see parameters.py: summary_level), the estimator does not
+    # save its default loss summaries either
+    save_summary_steps = None if parameters.summary_level == 'off' else 100
+    checkpointing_config = tf.estimator.RunConfig(keep_checkpoint_max=2, save_summary_steps=save_summary_steps)
 
     capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
                                     config=checkpointing_config,
@@ -114,7 +113,16 @@ for idx_execution in range(n_iterations):
         # Lets have less logs:
         logging.getLogger().setLevel(logging.CRITICAL)
 
-        # Testing for each test stimulus category:
+        # Lets get all the network performance results we need in a single
+        # prediction pass over all test files:
+        capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
+                                        params={'log_dir': log_dir,
+                                                'get_reconstructions': False})
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy, rank_pred_shapes, rank_pred_proba, n_samples = group_crowding_predictions(
+                capser_out, n_categories, n_idx)
+
+        # Save the results for each test stimulus category:
         cats = []
         res = []
         for n_category in range(n_categories):
@@ -123,28 +131,15 @@ for idx_execution in range(n_iterations):
             print('-------------------------------------------------------')
             print('Compute vernier offset for ' + category)
 
-            results0 = np.zeros(shape=(n_idx,))
+            results0 = vernier_accuracy[n_category, :]
             for stim_idx in range(n_idx):
-                # Load relevant tfrecord test stimulus file
-                test_filename = category + '/' + str(stim_idx) + '.tfrecords'
-
-                # Lets get all the network performance results we need:
-                capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
-                                                params={'log_dir': log_dir,
-                                                        'get_reconstructions': False})
-                capser_out = list(capser.predict(lambda: predict_input_fn(test_filename)))
-                vernier_accuracy = [p['vernier_accuracy'] for p in capser_out]
-                rank_pred_shapes = [p['rank_pred_shapes'] for p in capser_out]
-                rank_pred_proba = [p['rank_pred_proba'] for p in capser_out]
-
                 # Get all the results per round:
-                results0[stim_idx] = np.mean(vernier_accuracy)
-                results1 = np.unique(rank_pred_shapes)
-                results2 = np.mean(rank_pred_proba, 0)
-                res.append(np.mean(vernier_accuracy))
+                results1 = rank_pred_shapes[n_category][stim_idx]
+                results2 = rank_pred_proba[n_category, stim_idx, :]
+                res.append(results0[stim_idx])
 
                 print('Finished calculations for stimulus type ' + str(stim_idx))
-                print('Result: ' + str(results0[stim_idx]) + '; test_samples used: ' + str(len(vernier_accuracy)))
+                print('Result: ' + str(results0[stim_idx]) + '; test_samples used: ' + str(int(n_samples[n_category, stim_idx])))
 
                 # Save ranking results (which shapes did the network recognize
                 # with the highest probabilities?):
@@ -22,7 +22,7 @@ conv_layers, primary_caps_layer, secondary_caps_layer, \
 predict_shapelabels, create_masked_decoder_input, compute_margin_loss, \
 compute_accuracy, compute_reconstruction, compute_reconstruction_loss, \
 compute_vernieroffset_loss, compute_nshapes_loss, compute_location_loss, \
-shape_loss_cnn, compute_vernieroffset_loss_cnn
+compute_fused_auxiliary_hidden, shape_loss_cnn, compute_vernieroffset_loss_cnn, recurrent_loop
 
 
 # model function for capsule network
@@ -53,13 +53,12 @@ def capser_model_fn(features, labels, mode, params):
     
     # Plot each four (reconstructed) input images in tensorboard
     plot_n_images = 4
-    tf.summary.image('full_input_images', input_images, plot_n_images)
+    if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level == 'full':
+        tf.summary.image('full_input_images', input_images, plot_n_images)
     
-    # If we pass a batch size via params, use this one
-    try:
-        batch_size = params['batch_size']
-    except:
-        batch_size = parameters.batch_size
+    # The batch size is taken from the inputs, so that batches of any size
+    # can be used (e.g. the last, smaller batch of a test set)
+    batch_size = tf.shape(input_images)[0]
     
     # If we pass a parameter for getting reconstructions, use it, otherwise
     # do not create reconstructions during testing
@@ -68,6 +67,10 @@ def capser_model_fn(features, labels, mode, params):
     except:
         get_reconstructions = False
 
+    # In prediction mode, we only build the decoders if their outputs are
+    # requested. The reconstructions are opt-in via params:
+    build_decoders = mode != tf.estimator.ModeKeys.PREDICT or get_reconstructions
+
     # We need to know how many different shape types can occur in the input image
     if mode == tf.estimator.ModeKeys.PREDICT:
         n_shapes  = shapelabels.shape[1]
@@ -92,12 +95,23 @@ def capser_model_fn(features, labels, mode, params):
     # Create convolutional layers and their output:
     conv_output, conv_output_sizes = conv_layers(input_images, parameters, is_training)
     
-    # Create primary caps and their output:
-    caps1_output = primary_caps_layer(conv_output, parameters)
+    # For inference, we can skip inactive primary capsules in the routing
+    # (see parameters.py: caps1_threshold):
+    if mode == tf.estimator.ModeKeys.PREDICT:
+        caps1_threshold = parameters.caps1_threshold
+    else:
+        caps1_threshold = 0.
     
-    # Create secondary caps and compute their output.
-    # Also, we need the individual outputs of the vernier caps and shape caps
-    caps2_output, caps2_output_norm = secondary_caps_layer(caps1_output, batch_size, parameters)
+    # The capsule layers (incl. routing) consist of many small ops, so we
+    # optionally compile them with XLA (see parameters.py: xla_caps):
+    with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=parameters.xla_caps):
+        # Create primary caps and their output:
+        caps1_output = primary_caps_layer(conv_output, parameters)
+        
+        # Create secondary caps and compute their output.
+        # Also, we need the individual outputs of the vernier caps and shape caps
+        caps2_output, caps2_output_norm, n_iter_routing = secondary_caps_layer(caps1_output, batch_size, parameters,
+                                                                               caps1_threshold=caps1_threshold)
     shape_1_caps_activation = caps2_output[:, :, 0, :, :]
     shape_1_caps_activation = tf.expand_dims(shape_1_caps_activation, 2)
 
@@ -109,10 +123,12 @@ def capser_model_fn(features, labels, mode, params):
         
         # Visualizations for tensorboard
         vernieroffset_loss = parameters.alpha_vernieroffset * vernieroffset_loss
-        tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
-        tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
-        tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
-        tf.summary.histogram('vernierlabels_real', vernierlabels)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level != 'off':
+            tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
+            tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level == 'full':
+            tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
+            tf.summary.histogram('vernierlabels_real', vernierlabels)
     
     
     ##########################################
@@ -120,13 +136,15 @@ def capser_model_fn(features, labels, mode, params):
     ##########################################
     # How many shapes have to be predicted? Predict them:
         with tf.name_scope('2_predict_shapes'):
-            # For reconstructions during testing, we would like to get the
-            # top three predicted shapes
-            if get_reconstructions:
-                pred_n_shapes = 3
-            else:
-                pred_n_shapes = n_shapes
-            shapelabels_pred = predict_shapelabels(caps2_output, pred_n_shapes)[0]
+            # The predicted shapes are only needed for the decoders. For
+            # reconstructions during testing, we would like to get the top
+            # three predicted shapes
+            if build_decoders:
+                if get_reconstructions:
+                    pred_n_shapes = 3
+                else:
+                    pred_n_shapes = n_shapes
+                shapelabels_pred = predict_shapelabels(caps2_output, pred_n_shapes)[0]
             
             # For prediction: give me a ranking of most probably shapes:
             rank_pred_shapes, rank_pred_proba = predict_shapelabels(caps2_output, len(parameters.shape_types))
@@ -136,26 +154,45 @@ def capser_model_fn(features, labels, mode, params):
     #     Create masked decoder input        #
     ##########################################
     with tf.name_scope('3_Masked_decoder_input'):
-        if n_shapes==2:
-            shape_1_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels[:, 0], shapelabels_pred[:, 0], caps2_output, parameters)
-            shape_2_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 1], caps2_output, parameters)
+        if build_decoders:
+            if n_shapes==2:
+                shape_1_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels[:, 0], shapelabels_pred[:, 0], caps2_output, parameters)
+                shape_2_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 1], caps2_output, parameters)
             
-        elif n_shapes==1:
-            shape_1_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels, shapelabels_pred, caps2_output, parameters)
+            elif n_shapes==1:
+                shape_1_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels, shapelabels_pred, caps2_output, parameters)
+
+            # For reconstructions during testing, we also need the third shape:
+            if get_reconstructions:
+                shape_3_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 2], caps2_output, parameters)
 
 
     ##########################################
     #         Decode reconstruction          #
     ##########################################
     with tf.name_scope('4_Reconstruction_loss'):
-        if parameters.decode_reconstruction:
+        if parameters.decode_reconstruction and build_decoders:
             if n_shapes==2:
-                # Create decoder outputs for shape_1 and shape_2 images
-                shape_1_output_reconstructed = compute_reconstruction(shape_1_decoder_input, parameters, is_training, conv_output_sizes)
-                shape_2_output_reconstructed = compute_reconstruction(shape_2_decoder_input, parameters, is_training, conv_output_sizes)
+                # Create decoder outputs for shape_1 and shape_2 images (and the
+                # third shape for reconstructions during testing):
+                decoder_inputs = [shape_1_decoder_input, shape_2_decoder_input]
+                if get_reconstructions:
+                    decoder_inputs.append(shape_3_decoder_input)
+                if parameters.batch_norm_reconstruction:
+                    # Batch normalization statistics are computed per shape
+                    output_reconstructed = [compute_reconstruction(decoder_input, parameters, is_training, conv_output_sizes)
+                                            for decoder_input in decoder_inputs]
+                else:
+                    # Decode all shapes in a single pass by stacking the decoder
+                    # inputs along the batch dimension:
+                    output_reconstructed = compute_reconstruction(tf.concat(decoder_inputs, axis=0), parameters,
+                                                                  is_training, conv_output_sizes)
+                    output_reconstructed = tf.split(output_reconstructed, len(decoder_inputs), axis=0)
+                shape_1_output_reconstructed, shape_2_output_reconstructed = output_reconstructed[:2]
                 
                 shape_1_img_reconstructed = tf.reshape(
                         shape_1_output_reconstructed,
@@ -166,18 +203,19 @@ def capser_model_fn(features, labels, mode, params):
                         [batch_size, parameters.im_size[0], parameters.im_size[1], parameters.im_depth],
                         name='shape_2_img_reconstructed')
 
-                # Create an rgb tf.summary image for tensorboard
-                color_masks = tf.cast(tf.convert_to_tensor([[121, 199, 83],  # 0: vernier, green
-                                                            [220, 76, 70],   # 1: red
-                                                            [79, 132, 196]]), tf.float32)  # 3: blue
-                color_masks = tf.expand_dims(color_masks, axis=1)
-                color_masks = tf.expand_dims(color_masks, axis=1)
-                decoder_output_images_rgb_0 = tf.image.grayscale_to_rgb(shape_1_img_reconstructed) * color_masks[0, :, :, :]
-                decoder_output_images_rgb_1 = tf.image.grayscale_to_rgb(shape_2_img_reconstructed) * color_masks[1, :, :, :]
-
-                # Visualization in tensorboard
-                decoder_output_img = decoder_output_images_rgb_0 + decoder_output_images_rgb_1
-                tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
+                # Create an rgb tf.summary image for tensorboard (only built, if it is
+                # visualized, see parameters.py: summary_level)
+                if parameters.summary_level == 'full':
+                    color_masks = tf.cast(tf.convert_to_tensor([[121, 199, 83],  # 0: vernier, green
+                                                                [220, 76, 70],   # 1: red
+                                                                [79, 132, 196]]), tf.float32)  # 3: blue
+                    color_masks = tf.expand_dims(color_masks, axis=1)
+                    color_masks = tf.expand_dims(color_masks, axis=1)
+                    decoder_output_images_rgb_0 = tf.image.grayscale_to_rgb(shape_1_img_reconstructed) * color_masks[0, :, :, :]
+                    decoder_output_images_rgb_1 = tf.image.grayscale_to_rgb(shape_2_img_reconstructed) * color_masks[1, :, :, :]
+
+                    decoder_output_img = decoder_output_images_rgb_0 + decoder_output_images_rgb_1
+                    tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
                 
                 # Calculate reconstruction loss for shape_1 and shape_2 images
                 shape_1_reconstruction_loss = compute_reconstruction_loss(shape_1_images, shape_1_output_reconstructed, parameters)
@@ -197,7 +235,8 @@ def capser_model_fn(features, labels, mode, params):
                         [batch_size, parameters.im_size[0], parameters.im_size[1], parameters.im_depth],
                         name='shape_1_img_reconstructed')
     
-                tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
+                if parameters.summary_level == 'full':
+                    tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
                 
                 # Calculate reconstruction loss for shape_1 images
                 shape_1_reconstruction_loss = compute_reconstruction_loss(shape_1_images, shape_1_output_reconstructed, parameters)
@@ -212,9 +251,10 @@ def capser_model_fn(features, labels, mode, params):
             reconstruction_loss = 0.
 
         # Visualization in tensorboard
-        tf.summary.scalar('shape_1_reconstruction_loss', shape_1_reconstruction_loss)
-        tf.summary.scalar('shape_2_reconstruction_loss', shape_2_reconstruction_loss)
-        tf.summary.scalar('reconstruction_loss', reconstruction_loss)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level != 'off':
+            tf.summary.scalar('shape_1_reconstruction_loss', shape_1_reconstruction_loss)
+            tf.summary.scalar('shape_2_reconstruction_loss', shape_2_reconstruction_loss)
+            tf.summary.scalar('reconstruction_loss', reconstruction_loss)
     
     
     ##########################################
@@ -224,13 +264,9 @@ def capser_model_fn(features, labels, mode, params):
     if mode == tf.estimator.ModeKeys.PREDICT:
         if get_reconstructions:
             # If we want to get reconstructions of the top three shapes during
-            # testing, we need to also create a reconstruction for the third 
-            # shape here:
-            shape_3_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 2], caps2_output, parameters)
-            shape_3_output_reconstructed = compute_reconstruction(shape_3_decoder_input, parameters, is_training, conv_output_sizes)
+            # testing, we also need the reconstruction of the third shape:
             shape_3_img_reconstructed = tf.reshape(
-                    shape_3_output_reconstructed,
+                    output_reconstructed[2],
                     [batch_size, parameters.im_size[0], parameters.im_size[1], parameters.im_depth],
                     name='shape_3_img_reconstructed')
             
@@ -243,9 +279,17 @@ def capser_model_fn(features, labels, mode, params):
             # on the vernier accuracy. Furthermore, we are outputting the
             # caps2 output norms to judge how confident the network was that
             # a specific shape was present in the input image
-            predictions = {'vernier_accuracy': tf.ones(shape=batch_size) * vernieroffset_accuracy,
+            predictions = {'vernier_accuracy': tf.ones(shape=[batch_size]) * vernieroffset_accuracy,
+                           'vernier_correct': tf.cast(tf.equal(vernierlabels_pred, vernierlabels[:, 0]), tf.float32),
                            'rank_pred_shapes': rank_pred_shapes,
-                           'rank_pred_proba': rank_pred_proba}
+                           'rank_pred_proba': rank_pred_proba,
+                           'n_iter_routing': n_iter_routing}
+
+            # Pass on the tags of the test files, if all test files are tested in
+            # a single prediction pass (see crowding_input_fn in capser_input_fn.py)
+            if 'category_idx' in features:
+                predictions['category_idx'] = features['category_idx']
+                predictions['stim_idx'] = features['stim_idx']
         
         spec = tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
 
@@ -261,30 +305,51 @@ def capser_model_fn(features, labels, mode, params):
         with tf.name_scope('5_margin'):
             # Compute accuracy:
             accuracy = compute_accuracy(shapelabels, shapelabels_pred)
-            tf.summary.scalar('margin_accuracy', accuracy)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('margin_accuracy', accuracy)
 
             # Define the loss-function to be optimized
             margin_loss = compute_margin_loss(caps2_output_norm, shapelabels, parameters)
             margin_loss = parameters.alpha_margin * margin_loss
             
             # Visualization in tensorboard
-            tf.summary.scalar('margin_loss', margin_loss)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('margin_loss', margin_loss)
     
 
+    ##########################################
+    #      Fused auxiliary decoders          #
+    ##########################################
+        # Optionally, compute the hidden layers of the nshapes and location
+        # decoders for all shapes with a single fused dense layer:
+        if parameters.fuse_auxiliary_decoders and (parameters.decode_nshapes or parameters.decode_location):
+            with tf.name_scope('6_Fused_auxiliary_decoders'):
+                if n_shapes==2:
+                    decoder_inputs = [shape_1_decoder_input, shape_2_decoder_input]
+                elif n_shapes==1:
+                    decoder_inputs = [shape_1_decoder_input]
+                hidden_nshapes, hidden_x, hidden_y = compute_fused_auxiliary_hidden(decoder_inputs, parameters)
+        else:
+            hidden_nshapes, hidden_x, hidden_y = [None]*2, [None]*2, [None]*2
+
+
     ##########################################
     #            Decode nshapes              #
     ##########################################
         with tf.name_scope('6_Nshapes_loss'):
             if parameters.decode_nshapes:
                 if n_shapes==2:
-                    nshapes_1_loss, nshapes_1_accuracy = compute_nshapes_loss(shape_1_decoder_input, nshapeslabels[:, 0], parameters, is_training)
-                    nshapes_2_loss, nshapes_2_accuracy = compute_nshapes_loss(shape_2_decoder_input, nshapeslabels[:, 1], parameters, is_training)
+                    nshapes_1_loss, nshapes_1_accuracy = compute_nshapes_loss(shape_1_decoder_input, nshapeslabels[:, 0], parameters,
+                                                                              is_training, hidden_nshapes[0])
+                    nshapes_2_loss, nshapes_2_accuracy = compute_nshapes_loss(shape_2_decoder_input, nshapeslabels[:, 1], parameters,
+                                                                              is_training, hidden_nshapes[1])
                     
                     nshapes_loss = parameters.alpha_nshapes * (nshapes_1_loss + nshapes_2_loss)
                     nshapes_accuracy = (nshapes_1_accuracy + nshapes_2_accuracy) / 2
                     
                 elif n_shapes==1:
-                    nshapes_loss, nshapes_accuracy = compute_nshapes_loss(shape_1_decoder_input, nshapeslabels, parameters, is_training)
+                    nshapes_loss, nshapes_accuracy = compute_nshapes_loss(shape_1_decoder_input, nshapeslabels, parameters,
+                                                                          is_training, hidden_nshapes[0])
                     nshapes_loss = parameters.alpha_nshapes*nshapes_loss
                     
             else:
@@ -292,8 +357,9 @@ def capser_model_fn(features, labels, mode, params):
                 nshapes_accuracy = 0.
                 
             # Visualization in tensorboard
-            tf.summary.scalar('nshapes_loss', nshapes_loss)
-            tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('nshapes_loss', nshapes_loss)
+                tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
 
 
     ##########################################
@@ -303,9 +369,11 @@ def capser_model_fn(features, labels, mode, params):
             if parameters.decode_location:
                 if n_shapes==2:
                     x_shape_1_loss, y_shape_1_loss = compute_location_loss(
-                            shape_1_decoder_input, x_shape_1, y_shape_1, parameters, 'shape_1', is_training)
+                            shape_1_decoder_input, x_shape_1, y_shape_1, parameters, 'shape_1', is_training,
+                            hidden_x[0], hidden_y[0])
                     x_shape_2_loss, y_shape_2_loss = compute_location_loss(
-                            shape_2_decoder_input, x_shape_2, y_shape_2, parameters, 'shape_2', is_training)
+                            shape_2_decoder_input, x_shape_2, y_shape_2, parameters, 'shape_2', is_training,
+                            hidden_x[1], hidden_y[1])
     
                     x_shape_1_loss = parameters.alpha_x_shape_1_loss * x_shape_1_loss
                     y_shape_1_loss = parameters.alpha_y_shape_1_loss * y_shape_1_loss
@@ -316,7 +384,8 @@ def capser_model_fn(features, labels, mode, params):
                     
                 elif n_shapes==1:
                     x_shape_1_loss, y_shape_1_loss = compute_location_loss(
-                            shape_1_decoder_input, x_shape_1, y_shape_1, parameters, 'shape_1', is_training)
+                            shape_1_decoder_input, x_shape_1, y_shape_1, parameters, 'shape_1', is_training,
+                            hidden_x[0], hidden_y[0])
     
                     x_shape_1_loss = parameters.alpha_x_shape_1_loss * x_shape_1_loss
                     y_shape_1_loss = parameters.alpha_y_shape_1_loss * y_shape_1_loss
@@ -333,11 +402,12 @@ def capser_model_fn(features, labels, mode, params):
                 location_loss = 0.
             
             # Visualization in tensorboard
-            tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
-            tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
-            tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
-            tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
-            tf.summary.scalar('location_loss', location_loss)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
+                tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
+                tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
+                tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
+                tf.summary.scalar('location_loss', location_loss)
 
 
     ##########################################
@@ -366,12 +436,17 @@ def capser_model_fn(features, labels, mode, params):
             train_op = optimizer.minimize(loss=final_loss, global_step=tf.train.get_global_step(), name='train_op')
             
             # Visualization in tensorboard
-            tf.summary.scalar('learning_rate', learning_rate)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('learning_rate', learning_rate)
         
         # Write summaries during evaluation
-        eval_summary_hook = tf.train.SummarySaverHook(save_steps=100,
-                                                      output_dir=log_dir + '/eval',
-                                                      summary_op=tf.summary.merge_all())
+        # (if no summaries are built, there is nothing to write)
+        if parameters.summary_level != 'off':
+            evaluation_hooks = [tf.train.SummarySaverHook(save_steps=100,
+                                                          output_dir=log_dir + '/eval',
+                                                          summary_op=tf.summary.merge_all())]
+        else:
+            evaluation_hooks = []
         
         # Wrap all of this in an EstimatorSpec
         spec = tf.estimator.EstimatorSpec(
@@ -379,7 +454,7 @@ def capser_model_fn(features, labels, mode, params):
             loss=final_loss,
             train_op=train_op,
             eval_metric_ops={},
-            evaluation_hooks=[eval_summary_hook])
+            evaluation_hooks=evaluation_hooks)
     
     return spec
 
@@ -413,13 +488,12 @@ def cnn_model_fn(features, labels, mode, params):
     input_images = tf.add(shape_1_images, shape_2_images, name='input_images')
     input_images = tf.clip_by_value(input_images, parameters.clip_values[0], parameters.clip_values[1],
                                     name='input_images_clipped')
-    tf.summary.image('full_input_images', input_images, plot_n_images)
+    if parameters.summary_level == 'full':
+        tf.summary.image('full_input_images', input_images, plot_n_images)
 
-    # If we pass a batch size via params, use this one
-    try:
-        batch_size = params['batch_size']
-    except:
-        batch_size = parameters.batch_size
+    # The batch size is taken from the inputs, so that batches of any size
+    # can be used (e.g. the last, smaller batch of a test set)
+    batch_size = tf.shape(input_images)[0]
 
     # We need to know how many different shape types can occur in the input image
     if mode == tf.estimator.ModeKeys.PREDICT:
@@ -453,36 +527,42 @@ def cnn_model_fn(features, labels, mode, params):
         flat_conv_output = tf.nn.elu(flat_conv_output)
         cnn_output = tf.layers.dense(flat_conv_output, parameters.caps2_ncaps * parameters.caps2_ndims, use_bias=True,
                                      activation=tf.nn.elu, name='fc_layer')
+        cnn_output_iters = tf.expand_dims(cnn_output, 0)
 
-    # LATERAL RNN VERSION // there is no simple RNN class that we can use in tf.Estimators, so instead we repeatedly use the same fc layer with the same parameters
+    # LATERAL RNN VERSION // there is no simple RNN class that we can use in tf.Estimators, so instead we repeatedly use
+    # the same fc layer with the same parameters in a tf.while_loop (the first iteration is computed before the loop).
+    # The recurrent layer is built before the loop, because variables cannot be created inside of it
     elif parameters.net_type == 'LATERAL_RNN':
         with tf.variable_scope('LATERAL_RNN'):
             bottom_layer = tf.nn.elu(flat_conv_output)
             bottom_up_input = tf.layers.dense(bottom_layer, parameters.caps2_ncaps * parameters.caps2_ndims,
                                               use_bias=True, activation=None, name='bottum_up')
             recurrent_state = tf.nn.elu(bottom_up_input)
-        for i in range(parameters.iter_routing - 1):  # -1 because the first iteration is above
-            with tf.variable_scope('LATERAL_RNN', reuse=tf.AUTO_REUSE):
-                recurrent_input = tf.layers.dense(recurrent_state, parameters.caps2_ncaps * parameters.caps2_ndims,
-                                                  use_bias=True, activation=None, name='recurrent')
-                recurrent_state = tf.nn.elu(bottom_up_input + recurrent_input)
-        cnn_output = recurrent_state
-
-    # TOPDOWN RNN VERSION // there is no simple RNN class that we can use in tf.Estimators, so instead we repeatedly use the same fc layer with the same parameters
+            recurrent_layer = tf.layers.Dense(parameters.caps2_ncaps * parameters.caps2_ndims, use_bias=True,
+                                              activation=None, name='recurrent')
+            recurrent_layer.build(recurrent_state.get_shape())
+
+            def lateral_step(recurrent_state):
+                return tf.nn.elu(bottom_up_input + recurrent_layer(recurrent_state))
+
+            cnn_output, cnn_output_iters = recurrent_loop(lateral_step, recurrent_state, parameters.iter_routing)
+
+    # TOPDOWN RNN VERSION // same as above, but with top-down connections from the top layer to the bottom layer
     elif parameters.net_type == 'TOPDOWN_RNN':
         with tf.variable_scope('TOPDOWN_RNN'):
             bottom_layer = tf.nn.elu(flat_conv_output)
-            bottom_layer_shape = 1680  # n_units in bottom_layer
-            top_layer = tf.layers.dense(bottom_layer, parameters.caps2_ncaps * parameters.caps2_ndims, use_bias=True,
-                                        activation=tf.nn.elu, name='top_layer')
-        for i in range(parameters.iter_routing - 1):  # -1 because the first iteration is above
-            with tf.variable_scope('TOPDOWN_RNN', reuse=tf.AUTO_REUSE):
-                top_down_input = tf.layers.dense(top_layer, bottom_layer_shape, use_bias=True, activation=None,
-                                                 name='top_down_input')
-                bottom_layer = tf.nn.elu(flat_conv_output + top_down_input)
-                top_layer = tf.layers.dense(bottom_layer, parameters.caps2_ncaps * parameters.caps2_ndims,
-                                            use_bias=True, activation=tf.nn.elu, name='top_layer')
-        cnn_output = top_layer
+            bottom_layer_shape = flat_conv_output.get_shape().as_list()[-1]  # n_units in bottom_layer
+            top_layer_dense = tf.layers.Dense(parameters.caps2_ncaps * parameters.caps2_ndims, use_bias=True,
+                                              activation=tf.nn.elu, name='top_layer')
+            top_layer = top_layer_dense(bottom_layer)
+            top_down_layer = tf.layers.Dense(bottom_layer_shape, use_bias=True, activation=None, name='top_down_input')
+            top_down_layer.build(top_layer.get_shape())
+
+            def topdown_step(top_layer):
+                bottom_layer = tf.nn.elu(flat_conv_output + top_down_layer(top_layer))
+                return top_layer_dense(bottom_layer)
+
+            cnn_output, cnn_output_iters = recurrent_loop(topdown_step, top_layer, parameters.iter_routing)
 
     else:
         raise Exception('Network type not understood, please use "CNN", "LATERAL_RNN OR TOPDOWN_RNN '
@@ -494,16 +574,30 @@ def cnn_model_fn(features, labels, mode, params):
     with tf.name_scope('1_vernier_acuity'):
         # this is the same function as in th capsnet, but adapted to deal with a fully-connected layer rather than
         # a capsules layer
-        vernierlabels_pred, vernieroffset_loss, vernieroffset_accuracy = compute_vernieroffset_loss_cnn(cnn_output,
-                                                                                                        vernierlabels,
-                                                                                                        parameters,
-                                                                                                        is_training)
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            # For predictions, we decode the vernier offsets after every recurrent step at once by stacking the steps
+            # along the batch dimension. The last step gives the usual predictions:
+            n_steps = cnn_output_iters.get_shape().as_list()[0]
+            vernierlabels_pred_iters, vernieroffset_loss, _ = compute_vernieroffset_loss_cnn(
+                tf.reshape(cnn_output_iters, [-1, parameters.caps2_ncaps * parameters.caps2_ndims]),
+                tf.tile(vernierlabels, [n_steps, 1]), parameters, is_training)
+            vernierlabels_pred_iters = tf.transpose(tf.reshape(vernierlabels_pred_iters, [n_steps, -1]))
+            vernierlabels_pred = vernierlabels_pred_iters[:, -1]
+            vernieroffset_accuracy = tf.reduce_mean(tf.cast(tf.equal(vernierlabels_pred, vernierlabels[:, 0]), tf.float32))
+
+        else:
+            vernierlabels_pred, vernieroffset_loss, vernieroffset_accuracy = compute_vernieroffset_loss_cnn(cnn_output,
+                                                                                                            vernierlabels,
+                                                                                                            parameters,
+                                                                                                            is_training)
 
         vernieroffset_loss = parameters.alpha_vernieroffset * vernieroffset_loss
-        tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
-        tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
-        tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
-        tf.summary.histogram('vernierlabels_real', vernierlabels)
+        if parameters.summary_level != 'off':
+            tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
+            tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
+            tf.summary.histogram('vernierlabels_real', vernierlabels)
 
         ##########################################
         #             Predict shapes             #
@@ -524,7 +618,8 @@ def cnn_model_fn(features, labels, mode, params):
             recontructed = compute_reconstruction(cnn_output, parameters, is_training, conv_output_sizes)
             decoder_output_img = tf.reshape(recontructed, [batch_size, parameters.im_size[0], parameters.im_size[1],
                                                            parameters.im_depth], name='decoder_output_img')
-            tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
+            if parameters.summary_level == 'full':
+                tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
 
             # Calculate reconstruction loss for shape_1 images
             reconstruction_loss = compute_reconstruction_loss(shape_1_images, recontructed,
@@ -533,7 +628,8 @@ def cnn_model_fn(features, labels, mode, params):
         else:
             reconstruction_loss = 0.
 
-        tf.summary.scalar('reconstruction_loss', reconstruction_loss)
+        if parameters.summary_level != 'off':
+            tf.summary.scalar('reconstruction_loss', reconstruction_loss)
 
     ##########################################
     #            Prediction mode:            #
@@ -555,12 +651,21 @@ def cnn_model_fn(features, labels, mode, params):
                            'decoder_vernier_img': vernier_img_reconstructed}
 
         else:
-            predictions = {'vernier_accuracy': tf.ones(shape=batch_size) * vernieroffset_accuracy,
+            predictions = {'vernier_accuracy': tf.ones(shape=[batch_size]) * vernieroffset_accuracy,
+                           'vernier_correct': tf.cast(tf.equal(vernierlabels_pred, vernierlabels[:, 0]), tf.float32),
                            'rank_pred_shapes': rank_pred_shapes,
                            'rank_pred_proba': rank_proba_shapes,
                            'pred_vernier': vernierlabels_pred,
                            'real_vernier': vernierlabels,
-                           'input_images': input_images}
+                           'input_images': input_images,
+                           # Results after each recurrent step (second dimension):
+                           'vernier_correct_iters': tf.cast(tf.equal(vernierlabels_pred_iters, vernierlabels), tf.float32)}
+
+            # Pass on the tags of the test files, if all test files are tested in
+            # a single prediction pass (see crowding_input_fn in capser_input_fn.py)
+            if 'category_idx' in features:
+                predictions['category_idx'] = features['category_idx']
+                predictions['stim_idx'] = features['stim_idx']
 
         spec = tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
 
@@ -583,8 +688,9 @@ def cnn_model_fn(features, labels, mode, params):
                 nshapes_loss = 0.
                 nshapes_accuracy = 0.
 
-            tf.summary.scalar('nshapes_loss', nshapes_loss)
-            tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('nshapes_loss', nshapes_loss)
+                tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
 
         ##########################################
         #       Decode x and y coordinates       #
@@ -608,11 +714,12 @@ def cnn_model_fn(features, labels, mode, params):
                 y_shape_2_loss = 0.
                 location_loss = 0.
 
-            tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
-            tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
-            tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
-            tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
-            tf.summary.scalar('location_loss', location_loss)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
+                tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
+                tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
+                tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
+                tf.summary.scalar('location_loss', location_loss)
 
         ##########################################
         #              Final loss                #
@@ -634,12 +741,17 @@ def cnn_model_fn(features, labels, mode, params):
                                                            parameters.learning_rate_decay_steps, name='learning_rate')
             optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
             train_op = optimizer.minimize(loss=final_loss, global_step=tf.train.get_global_step(), name='train_op')
-            tf.summary.scalar('learning_rate', learning_rate)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('learning_rate', learning_rate)
 
         # write summaries during evaluation
-        eval_summary_hook = tf.train.SummarySaverHook(save_steps=100,
-                                                      output_dir=log_dir + '/eval',
-                                                      summary_op=tf.summary.merge_all())
+        # (if no summaries are built, there is nothing to write)
+        if parameters.summary_level != 'off':
+            evaluation_hooks = [tf.train.SummarySaverHook(save_steps=100,
+                                                          output_dir=log_dir + '/eval',
+                                                          summary_op=tf.summary.merge_all())]
+        else:
+            evaluation_hooks = []
 
         # Wrap all of this in an EstimatorSpec
         spec = tf.estimator.EstimatorSpec(
@@ -647,6 +759,6 @@ def cnn_model_fn(features, labels, mode, params):
             loss=final_loss,
             train_op=train_op,
             eval_metric_ops={},
-            evaluation_hooks=[eval_summary_hook])
+            evaluation_hooks=evaluation_hooks)
 
     return spec
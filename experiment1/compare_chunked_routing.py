@@ -0,0 +1,63 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script measures the deviation of the chunked routing (see parameters.py:
+routing_chunk_size) from the usual routing for random primary capsule
+outputs. Both routings only differ by the float summation order, so the
+deviations of the secondary capsule outputs and of their gradients are
+compared to the float32 precision for weights of different magnitudes.
+
+@author: Lynn Schmittwilken
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_functions import squash, secondary_caps_layer
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting chunked routing comparison...')
+print('-------------------------------------------------------')
+
+
+###########################
+#       Main script:      #
+###########################
+batch_size = parameters.batch_size
+routing_chunk_size = parameters.routing_chunk_size if parameters.routing_chunk_size else 64
+W_shape = [1, parameters.caps1_ncaps, parameters.caps2_ncaps, parameters.caps2_ndims, parameters.caps1_ndims]
+
+for W_sigma in [parameters.init_sigma, 0.1, 1.]:
+    tf.reset_default_graph()
+    caps1_output = squash(tf.random_normal([batch_size, parameters.caps1_ncaps, parameters.caps1_ndims],
+                                           seed=parameters.random_seed))
+    W_values = np.random.RandomState(parameters.random_seed).normal(0., W_sigma, W_shape).astype(np.float32)
+    W_init = lambda: tf.constant(W_values)
+
+    # The same weights and inputs for the usual and the chunked routing:
+    outputs = []
+    for chunk_size in [0, routing_chunk_size]:
+        parameters.routing_chunk_size = chunk_size
+        caps2_output, _, _ = secondary_caps_layer(caps1_output, batch_size, parameters, W_init=W_init)
+        caps2_output_grad = tf.gradients(tf.reduce_sum(tf.square(caps2_output)), caps1_output)[0]
+        outputs.append([caps2_output, caps2_output_grad])
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        [[caps2_output, caps2_output_grad], [caps2_output_chunked, caps2_output_grad_chunked]] = sess.run(outputs)
+
+    print('-------------------------------------------------------')
+    print('W sigma: ' + str(W_sigma) + '; routing_chunk_size: ' + str(routing_chunk_size))
+    print('Max. caps2 output norm: %.3f' % np.max(np.linalg.norm(caps2_output, axis=-2)))
+    print('Max. deviation of the caps2 outputs: %.2e' % np.max(np.abs(caps2_output_chunked - caps2_output)))
+    print('Max. relative deviation of the gradients: %.2e' %
+          (np.max(np.abs(caps2_output_grad_chunked - caps2_output_grad)) / np.max(np.abs(caps2_output_grad))))
+
+
+print('... Finished chunked routing comparison!')
+print('-------------------------------------------------------')
@@ -0,0 +1,91 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script compares training with gradients through all routing iterations
+to training with gradients through the final routing iteration only (see
+parameters.py: routing_stop_gradient). For both, it reports the time per
+training step and the final vernier accuracies on the crowding test sets.
+The datasets have to be created first (see make_tfrecords.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import logging
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import capser_model_fn
+from capser_input_fn import train_input_fn, predict_crowding_input_fn
+from capser_functions import group_crowding_predictions
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting routing gradient comparison...')
+print('-------------------------------------------------------')
+
+
+###########################
+#      Preparations:      #
+###########################
+# Number of training steps before timing (graph building, filling the
+# shuffle buffer):
+n_warmup_steps = 50
+
+n_idx = parameters.n_idx
+n_categories = len(parameters.test_crowding_data_paths)
+
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
+# Lets have less logs:
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+###########################
+#       Main script:      #
+###########################
+if not os.path.exists(parameters.logdir):
+    os.mkdir(parameters.logdir)
+
+txt_file_name = parameters.logdir + '/routing_stop_gradient_comparison.txt'
+with open(txt_file_name, 'w') as f:
+    for routing_stop_gradient in [False, True]:
+        parameters.routing_stop_gradient = routing_stop_gradient
+        log_dir = parameters.logdir + 'routing_stop_gradient_' + str(routing_stop_gradient) + '/'
+
+        # Always train from scratch, otherwise the step time of a rerun would
+        # be meaningless:
+        if tf.gfile.Exists(log_dir):
+            tf.gfile.DeleteRecursively(log_dir)
+
+        capser = tf.estimator.Estimator(model_fn=capser_model_fn, model_dir=log_dir,
+                                        params={'log_dir': log_dir})
+        capser.train(train_input_fn, steps=n_warmup_steps)
+        start = time.time()
+        capser.train(train_input_fn, max_steps=parameters.n_steps)
+        step_time = (time.time() - start) / (parameters.n_steps - n_warmup_steps)
+
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy, _, _, _ = group_crowding_predictions(capser_out, n_categories, n_idx)
+
+        report = ('routing_stop_gradient: ' + str(routing_stop_gradient) +
+                  '; time per step: %.1fms; mean vernier accuracy: %.4f\n'
+                  % (step_time*1000, np.mean(vernier_accuracy)))
+        for n_category in range(n_categories):
+            category = parameters.test_crowding_data_paths[n_category]
+            report += category + ' : \t' + str(vernier_accuracy[n_category, :]) + '\n'
+
+        print('-------------------------------------------------------')
+        print(report)
+        f.write(report + '\n')
+
+
+print('... Finished routing gradient comparison!')
+print('-------------------------------------------------------')
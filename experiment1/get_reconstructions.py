@@ -20,7 +20,8 @@ import pickle
 
 from parameters import parameters
 from batchmaker import stim_maker_fn
-from capser_model_fn import model_fn
+from capser_model_fn import capser_model_fn
+from capser_input_fn import serving_input_fn
 
 
 print('-------------------------------------------------------')
@@ -88,55 +89,6 @@ def create_batch(chosen_shape, stim_idx, batch_size, parameters):
                  'y_shape_2': y_shape_2}
     return feed_dict
 
-# Create an input function as needed for the Estimator API
-def predict_input_fn(feed_dict):
-    batch_size = feed_dict['shapelabels'].shape[0]
-    
-    shape_1_images = feed_dict['shape_1_images']
-    shape_2_images = feed_dict['shape_2_images']
-    shapelabels = feed_dict['shapelabels']
-    nshapeslabels = feed_dict['nshapeslabels']
-    vernier_offsets = feed_dict['vernier_offsets']
-    x_shape_1 = feed_dict['x_shape_1']
-    y_shape_1 = feed_dict['y_shape_1']
-    x_shape_2 = feed_dict['x_shape_2']
-    y_shape_2 = feed_dict['y_shape_2']
-    
-    dataset_test = tf.data.Dataset.from_tensor_slices((shape_1_images,
-                                                       shape_2_images,
-                                                       shapelabels,
-                                                       nshapeslabels,
-                                                       vernier_offsets,
-                                                       x_shape_1,
-                                                       y_shape_1,
-                                                       x_shape_2,
-                                                       y_shape_2))
-    dataset_test = dataset_test.batch(batch_size, drop_remainder=True)
-    
-    # Use pipelining to speed up things (see https://www.youtube.com/watch?v=SxOsJPaxHME)
-    dataset_test = dataset_test.prefetch(2)
-    
-    # Create an iterator for the dataset_test and the above modifications.
-    iterator = dataset_test.make_one_shot_iterator()
-    
-    # Get the next batch of images and labels.
-    [shape_1_images, shape_2_images, shapelabels, vernierlabels, nshapeslabels,
-     x_shape_1, y_shape_1, x_shape_2, y_shape_2] = iterator.get_next()
-    
-    feed_dict = {'shape_1_images': shape_1_images,
-                 'shape_2_images': shape_2_images,
-                 'shapelabels': shapelabels,
-                 'nshapeslabels': nshapeslabels,
-                 'vernier_offsets': vernierlabels,
-                 'x_shape_1': x_shape_1,
-                 'y_shape_1': y_shape_1,
-                 'x_shape_2': x_shape_2,
-                 'y_shape_2': y_shape_2,
-                 'mask_with_labels': False,
-                 'is_training': False}
-
-    return feed_dict
-
 
 def plot_reconstructions(originals, results1, results2, results3, save=None):
     '''
@@ -224,7 +176,14 @@ for idx_execution in range(n_iterations):
     # Lets have less logs:
     logging.getLogger().setLevel(logging.CRITICAL)        
     
-    # The network should already be trained, so here we just do testing
+    # The network should already be trained, so here we just do testing.
+    # The network gets restored only once and is then reused for all numpy
+    # batches that we feed into it:
+    capser = tf.estimator.Estimator(model_fn=capser_model_fn, model_dir=log_dir,
+                                    params={'log_dir': log_dir,
+                                            'get_reconstructions': True})
+    predictor = tf.contrib.predictor.from_estimator(capser, lambda: serving_input_fn(parameters))
+    
     for n_category in range(n_categories):
         category_idx = parameters.test_shape_types[n_category]
         category = parameters.test_crowding_data_paths[n_category]
@@ -233,16 +192,11 @@ for idx_execution in range(n_iterations):
         
         for stim_idx in range(n_idx):            
             # Get reconstructions using the following path:
-            capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
-                                            params={'log_dir': log_dir,
-                                                    'get_reconstructions': True,
-                                                    'batch_size': batch_size})
             feed_dict = create_batch(category_idx, stim_idx, batch_size, parameters)
-            
-            capser_out = list(capser.predict(lambda: predict_input_fn(feed_dict)))
-            results1 = [p['decoder_output_img1'] for p in capser_out]
-            results2 = [p['decoder_output_img2'] for p in capser_out]
-            results3 = [p['decoder_output_img3'] for p in capser_out]
+            capser_out = predictor(feed_dict)
+            results1 = capser_out['decoder_output_img1']
+            results2 = capser_out['decoder_output_img2']
+            results3 = capser_out['decoder_output_img3']
             
             # Plot and save the reconstruction images
             img_path = log_dir + '/reconstructions'
@@ -250,8 +204,7 @@ for idx_execution in range(n_iterations):
             if not os.path.exists(img_path):
                 os.mkdir(img_path)
             originals = feed_dict['shape_1_images'] + feed_dict['shape_2_images']
-            plot_reconstructions(originals, np.asarray(results1), np.asarray(results2),
-                                 np.asarray(results3), img_file)
+            plot_reconstructions(originals, results1, results2, results3, img_file)
             
             # Also save reconstructions into pckl files for each configuration
             if save_pckl:
@@ -199,9 +199,19 @@ if not os.path.exists(parameters.data_path):
 if training:
     mode = 'training'
     shape_types_train = parameters.shape_types
-    make_tfrecords(parameters.train_data_path, stim_maker, mode, shape_types_train, parameters.n_shapes,
-                   parameters.n_train_samples, parameters.train_procedure, parameters.overlapping_shapes,
-                   centralize=parameters.centralized_shapes, reduce_df=parameters.reduce_df)
+    # The training set is split into n_train_shards files (the last shard gets
+    # the remaining samples). The shard index replaces the * in the path:
+    if parameters.train_data_path.count('*') != 1:
+        raise SystemExit('\nPROBLEM: train_data_path needs exactly one * for the shard index '
+                         '(e.g. ./data/train_*.tfrecords)!\n')
+    for shard_idx in range(parameters.n_train_shards):
+        n_shard_samples = parameters.n_train_samples // parameters.n_train_shards
+        if shard_idx == parameters.n_train_shards - 1:
+            n_shard_samples += parameters.n_train_samples % parameters.n_train_shards
+        train_file_path = parameters.train_data_path.replace('*', str(shard_idx))
+        make_tfrecords(train_file_path, stim_maker, mode, shape_types_train, parameters.n_shapes,
+                       n_shard_samples, parameters.train_procedure, parameters.overlapping_shapes,
+                       centralize=parameters.centralized_shapes, reduce_df=parameters.reduce_df)
     print('\n-------------------------------------------------------')
     print('Finished creation of training set')
     print('-------------------------------------------------------')
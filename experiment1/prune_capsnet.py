@@ -0,0 +1,258 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 1: Crowding and Uncrowding Naturally Occur in CapsNets
+
+This script prunes the trained capsule networks. The primary capsule maps are
+scored by their share of the routing agreement and by the drop of the vernier
+accuracy if they are removed. The filters of conv1 and conv2 are scored by
+their mean activation times the magnitude of the weights that read them in
+the next layer. The least useful maps and filters are removed (see
+prune_checkpoint in capser_functions.py), and the vernier accuracies before
+and after pruning are reported for each test condition.
+The networks have to be trained first (see capser_main.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import logging
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import capser_model_fn
+from capser_input_fn import predict_input_fn, predict_crowding_input_fn
+from capser_functions import conv_layers, primary_caps_layer, secondary_caps_layer, compute_vernieroffset_loss, \
+group_crowding_predictions, prune_checkpoint
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting capsnet pruning...')
+print('-------------------------------------------------------')
+
+
+###########################
+#    Helper functions:    #
+###########################
+def get_scoring_data(test_filenames, n_samples):
+    '''
+    Get the first samples of each test condition (as numpy arrays)
+
+    Parameters
+    ----------
+    test_filenames: list
+                    test_filenames[n_category][stim_idx] is the path of the
+                    test file
+    n_samples: int
+               Number of samples per test condition
+
+    Returns
+    -------
+    images: array
+            Input images of all test conditions
+    vernierlabels: array
+                   Corresponding vernier offset labels
+    '''
+    tf.reset_default_graph()
+    images, vernierlabels = [], []
+    for filename in [filename for category in test_filenames for filename in category]:
+        feed_dict, _ = predict_input_fn(filename)
+        input_images = tf.add(feed_dict['shape_1_images'], feed_dict['shape_2_images'])
+        input_images = tf.clip_by_value(input_images, parameters.clip_values[0], parameters.clip_values[1])
+        images.append(input_images[:n_samples])
+        vernierlabels.append(feed_dict['vernier_offsets'][:n_samples])
+
+    with tf.Session() as sess:
+        images, vernierlabels = sess.run([tf.concat(images, 0), tf.concat(vernierlabels, 0)])
+    return images, vernierlabels
+
+
+def compute_scores(log_dir, images, vernierlabels, chunk_size=100):
+    '''
+    Score the filters of conv1 and conv2 and the primary capsule maps of a
+    trained network
+
+    Parameters
+    ----------
+    log_dir: str
+             Directory of the trained network
+    images: array
+            Input images used for scoring
+    vernierlabels: array
+                   Corresponding vernier offset labels
+    chunk_size: int
+                Number of samples for which the routing agreement is computed
+                at once
+
+    Returns
+    -------
+    conv1_scores: array
+                  Score for each conv1 filter
+    conv2_scores: array
+                  Score for each conv2 filter
+    map_scores: array
+                Score for each primary capsule map
+    '''
+    n_positions = parameters.caps1_ncaps // parameters.caps1_nmaps
+
+    tf.reset_default_graph()
+    input_images = tf.placeholder(tf.float32, [None] + list(images.shape[1:]), name='input_images')
+    vernier_offsets = tf.placeholder(tf.float32, [None, 1], name='vernier_offsets')
+    caps1_mask = tf.placeholder_with_default(tf.ones([parameters.caps1_nmaps]), [parameters.caps1_nmaps],
+                                             name='caps1_mask')
+    conv_output, _ = conv_layers(input_images, parameters, False)
+    caps1_output = primary_caps_layer(conv_output, parameters)
+
+    # The primary capsule maps can be removed with the mask (ablation):
+    caps1_output = caps1_output * tf.reshape(tf.tile(caps1_mask, [n_positions]), [1, -1, 1])
+    caps2_output, _, _ = secondary_caps_layer(caps1_output, tf.shape(input_images)[0], parameters)
+    with tf.name_scope('1_vernier_acuity'):
+        _, _, vernier_accuracy = compute_vernieroffset_loss(tf.expand_dims(caps2_output[:, :, 0, :, :], 2),
+                                                            tf.cast(vernier_offsets, tf.int64), parameters, False)
+
+    graph = tf.get_default_graph()
+    conv1 = graph.get_tensor_by_name('1_convolutional_layers/conv1_activation:0')
+    conv2 = graph.get_tensor_by_name('1_convolutional_layers/conv2_activation:0')
+    variables = {variable.op.name: variable for variable in tf.global_variables()}
+
+    with tf.Session() as sess:
+        tf.train.Saver().restore(sess, tf.train.latest_checkpoint(log_dir))
+        feed_dict = {input_images: images, vernier_offsets: vernierlabels}
+        [conv1_output, conv2_output, caps1_output_value, caps2_output_value, accuracy, conv2_kernel, conv3_kernel,
+         W] = sess.run([conv1, conv2, caps1_output, caps2_output, vernier_accuracy, variables['conv2/kernel'],
+                        variables['conv3/kernel'], variables['3_secondary_caps_layer/W']], feed_dict)
+
+        # Drop of the vernier accuracy if a primary capsule map is removed:
+        accuracy_drop = np.zeros(parameters.caps1_nmaps)
+        for idx_map in range(parameters.caps1_nmaps):
+            mask = np.ones(parameters.caps1_nmaps)
+            mask[idx_map] = 0.
+            feed_dict[caps1_mask] = mask
+            accuracy_drop[idx_map] = accuracy - sess.run(vernier_accuracy, feed_dict)
+
+    # Activation of each conv filter times the weights that read it:
+    conv1_scores = np.mean(np.abs(conv1_output), axis=(0, 1, 2)) * np.sum(np.abs(conv2_kernel), axis=(0, 1, 3))
+    conv2_scores = np.mean(np.abs(conv2_output), axis=(0, 1, 2)) * np.sum(np.abs(conv3_kernel), axis=(0, 1, 3))
+
+    # For convolutional capsules, the primary capsules predict the secondary
+    # capsules of several windows, so we only use the drop of the accuracy:
+    if parameters.conv_caps:
+        return conv1_scores, conv2_scores, accuracy_drop
+
+    # Positive agreement between the predictions of each primary capsule and
+    # the final secondary capsule outputs:
+    if parameters.share_W:
+        W = np.tile(W, [1, n_positions, 1, 1, 1])
+    caps2_output_value = np.squeeze(caps2_output_value, axis=(1, 4))
+    agreement = np.zeros(parameters.caps1_nmaps)
+    for start in range(0, len(images), chunk_size):
+        caps2_predicted = np.einsum('ijed,bid->bije', W[0], caps1_output_value[start:start+chunk_size])
+        caps_agreement = np.einsum('bije,bje->bij', caps2_predicted, caps2_output_value[start:start+chunk_size])
+        caps_agreement = np.reshape(np.maximum(caps_agreement, 0.), [-1, n_positions, parameters.caps1_nmaps,
+                                                                      parameters.caps2_ncaps])
+        agreement += np.sum(caps_agreement, axis=(0, 1, 3))
+
+    map_scores = agreement / np.sum(agreement) + accuracy_drop
+    return conv1_scores, conv2_scores, map_scores
+
+
+###########################
+#      Preparations:      #
+###########################
+# How many primary capsule maps and which fraction of the conv1 and conv2
+# filters should be removed?
+n_prune_maps = 1
+prune_conv_fraction = 0.25
+
+# Number of samples per test condition used for scoring:
+n_score_samples = 48
+
+n_iterations = parameters.n_iterations
+n_idx = parameters.n_idx
+n_categories = len(parameters.test_crowding_data_paths)
+
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
+# Initialize results (0: before pruning, 1: after pruning)
+results = np.zeros(shape=(2, n_categories, n_idx, n_iterations))
+n_params = np.zeros(shape=(2, n_iterations))
+
+# Parameters of the unpruned networks:
+caps1_nmaps = parameters.caps1_nmaps
+caps1_ncaps = parameters.caps1_ncaps
+conv_params = parameters.conv_params
+
+# Lets have less logs:
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+###########################
+#       Main script:      #
+###########################
+images, vernierlabels = get_scoring_data(test_filenames, n_score_samples)
+
+for idx_execution in range(n_iterations):
+    log_dir = parameters.logdir + str(idx_execution) + '/'
+    pruned_dir = log_dir + 'pruned/'
+
+    # Remove the filters and maps with the lowest scores:
+    conv1_scores, conv2_scores, map_scores = compute_scores(log_dir, images, vernierlabels)
+    keep_conv1 = np.sort(np.argsort(conv1_scores)[int(prune_conv_fraction*len(conv1_scores)):])
+    keep_conv2 = np.sort(np.argsort(conv2_scores)[int(prune_conv_fraction*len(conv2_scores)):])
+    keep_maps = np.sort(np.argsort(map_scores)[n_prune_maps:])
+    n_params[:, idx_execution] = prune_checkpoint(tf.train.latest_checkpoint(log_dir), pruned_dir,
+                                                  keep_conv1, keep_conv2, keep_maps, parameters)
+
+    # The pruned network needs adjusted parameters:
+    pruned_params = {'caps1_nmaps': len(keep_maps),
+                     'caps1_ncaps': len(keep_maps) * caps1_ncaps // caps1_nmaps,
+                     'conv_params': [dict(conv_params[0], filters=len(keep_conv1)),
+                                     dict(conv_params[1], filters=len(keep_conv2)),
+                                     dict(conv_params[2], filters=len(keep_maps)*parameters.caps1_ndims)]}
+    with open(pruned_dir + 'pruned_parameters.txt', 'w') as f:
+        f.write('keep_conv1: ' + str(list(keep_conv1)) + '\n')
+        f.write('keep_conv2: ' + str(list(keep_conv2)) + '\n')
+        f.write('keep_maps: ' + str(list(keep_maps)) + '\n')
+        for key, value in pruned_params.items():
+            f.write(key + ': ' + str(value) + '\n')
+
+    for idx_model, model_dir in enumerate([log_dir, pruned_dir]):
+        if idx_model == 0:
+            parameters.caps1_nmaps, parameters.caps1_ncaps, parameters.conv_params = caps1_nmaps, caps1_ncaps, conv_params
+        else:
+            parameters.caps1_nmaps = pruned_params['caps1_nmaps']
+            parameters.caps1_ncaps = pruned_params['caps1_ncaps']
+            parameters.conv_params = pruned_params['conv_params']
+
+        capser = tf.estimator.Estimator(model_fn=capser_model_fn, model_dir=model_dir,
+                                        params={'log_dir': log_dir})
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy, _, _, _ = group_crowding_predictions(capser_out, n_categories, n_idx)
+        results[idx_model, :, :, idx_execution] = vernier_accuracy
+
+    parameters.caps1_nmaps, parameters.caps1_ncaps, parameters.conv_params = caps1_nmaps, caps1_ncaps, conv_params
+
+
+# Compare the pruned to the unpruned networks:
+mean_results = np.mean(results, axis=-1)
+deviation = np.mean(results[1] - results[0], axis=-1)
+txt_file_name = parameters.logdir + '/pruning_report.txt'
+with open(txt_file_name, 'w') as f:
+    report = ('pruned maps: ' + str(n_prune_maps) + '; pruned conv filters: ' + str(prune_conv_fraction) +
+              '; parameters: %d (unpruned), %d (pruned); mean abs deviation: %.4f; max abs deviation: %.4f\n'
+              % (np.mean(n_params[0]), np.mean(n_params[1]), np.mean(np.abs(deviation)), np.max(np.abs(deviation))))
+    for n_category in range(n_categories):
+        category = parameters.test_crowding_data_paths[n_category]
+        report += category + ' : \t' + str(mean_results[0, n_category, :]) + \
+        ' : \t' + str(mean_results[1, n_category, :]) + ' : \t' + str(deviation[n_category, :]) + '\n'
+
+    print('-------------------------------------------------------')
+    print(report)
+    f.write(report + '\n')
+
+
+print('... Finished capsnet pruning!')
+print('-------------------------------------------------------')
@@ -0,0 +1,85 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 2: The role of recurrent processing
+
+This script benchmarks the throughput of the input functions
+(see capser_input_fn.py) for different data augmentation settings, e.g. with
+and without the precomputed noise bank (see parameters.py: noise_bank).
+The datasets have to be created first (see make_tfrecords.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_input_fn import train_input_fn, predict_input_fn
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting input_fn benchmark...')
+print('-------------------------------------------------------')
+
+
+###########################
+#    Helper functions:    #
+###########################
+def get_throughput(input_fn, n_batches, n_warmup=20):
+    '''
+    Measure the number of samples per second that an input function delivers
+    
+    Parameters
+    ----------
+    input_fn: function
+              Input function as used for the Estimator API
+    n_batches: int
+               Number of batches used for timing
+    n_warmup: int
+              Number of batches that are drawn before timing (e.g. to fill the
+              shuffle buffer)
+    
+    Returns
+    -------
+    samples_per_sec
+    '''
+    tf.reset_default_graph()
+    feed_dict, _ = input_fn()
+    tensors = {key: value for key, value in feed_dict.items() if isinstance(value, tf.Tensor)}
+
+    with tf.Session() as sess:
+        for i in range(n_warmup):
+            sess.run(tensors)
+
+        # The last batch of a test set can be smaller, so we count the samples:
+        n_samples = 0
+        start = time.time()
+        for i in range(n_batches):
+            n_samples += len(sess.run(tensors)['shapelabels'])
+        duration = time.time() - start
+    return n_samples / duration
+
+
+###########################
+#       Main script:      #
+###########################
+n_batches = 500
+test_filename = parameters.test_crowding_data_paths[0] + '/0.tfrecords'
+n_test_batches = int(np.ceil(parameters.n_test_samples / parameters.predict_batch_size))
+
+for noise_bank in [False, True]:
+    parameters.noise_bank = noise_bank
+    train_throughput = get_throughput(train_input_fn, n_batches)
+    test_throughput = get_throughput(lambda: predict_input_fn(test_filename), n_test_batches - 1, n_warmup=1)
+
+    print('-------------------------------------------------------')
+    print('Noise bank: ' + str(noise_bank))
+    print('Training set: %.1f samples/sec' % train_throughput)
+    print('Test set: %.1f samples/sec' % test_throughput)
+
+
+print('... Finished input_fn benchmark!')
+print('-------------------------------------------------------')
@@ -0,0 +1,132 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 2: The role of recurrent processing
+
+This script checks that compiling the capsule layers (incl. routing) with XLA
+(see parameters.py: xla_caps) gives the same outputs as the default path and
+compares the time needed for a forward pass through the capsule layers.
+The datasets have to be created first (see make_tfrecords.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_input_fn import predict_input_fn
+from capser_functions import conv_layers, primary_caps_layer, secondary_caps_layer
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting XLA benchmark for the capsule layers...')
+print('-------------------------------------------------------')
+
+
+###########################
+#    Helper functions:    #
+###########################
+def get_test_images(filename):
+    '''
+    Get one batch of test images (as numpy array)
+
+    Parameters
+    ----------
+    filename: str
+              Path to the tfrecords file
+
+    Returns
+    -------
+    images
+    '''
+    tf.reset_default_graph()
+    feed_dict, _ = predict_input_fn(filename)
+    input_images = tf.add(feed_dict['shape_1_images'], feed_dict['shape_2_images'])
+    input_images = tf.clip_by_value(input_images, parameters.clip_values[0], parameters.clip_values[1])
+    with tf.Session() as sess:
+        images = sess.run(input_images)
+    return images
+
+
+def run_caps_layers(images, xla, variable_values=None, n_runs=100, n_warmup=5):
+    '''
+    Run the conv and capsule layers and time the forward pass
+
+    Parameters
+    ----------
+    images: array
+            Input images with shape [batch_size, im_size[0], im_size[1], im_depth]
+    xla: bool
+         If true, the capsule layers (incl. routing) get compiled with XLA
+    variable_values: dict
+                     If not None, the variables get these values (by name)
+                     so that both paths use the same weights
+    n_runs: int
+            Number of forward passes used for timing
+    n_warmup: int
+              Number of forward passes before timing (e.g. for compilation)
+
+    Returns
+    -------
+    caps2_output: array
+                  Secondary capsule output
+    variable_values: dict
+                     Values of all variables (by name)
+    duration: float
+              Mean time for one forward pass in seconds
+    '''
+    tf.reset_default_graph()
+    input_images = tf.placeholder(tf.float32, images.shape, name='input_images')
+    conv_output, _ = conv_layers(input_images, parameters, False)
+    with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=xla):
+        caps1_output = primary_caps_layer(conv_output, parameters)
+        caps2_output, _, _, _ = secondary_caps_layer(caps1_output, tf.shape(input_images)[0],
+                                                     parameters.train_iter_routing, parameters)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        if variable_values is not None:
+            for variable in tf.global_variables():
+                variable.load(variable_values[variable.name], sess)
+        variable_values = {variable.name: value for variable, value in
+                           zip(tf.global_variables(), sess.run(tf.global_variables()))}
+
+        for i in range(n_warmup):
+            sess.run(caps2_output, feed_dict={input_images: images})
+
+        start = time.time()
+        for i in range(n_runs):
+            output = sess.run(caps2_output, feed_dict={input_images: images})
+        duration = (time.time() - start) / n_runs
+    return output, variable_values, duration
+
+
+###########################
+#       Main script:      #
+###########################
+test_filename = parameters.test_crowding_data_paths[0] + '/0.tfrecords'
+images = get_test_images(test_filename)
+
+caps2_output, variable_values, duration = run_caps_layers(images, xla=False)
+caps2_output_xla, _, duration_xla = run_caps_layers(images, xla=True, variable_values=variable_values)
+
+# Correctness check: both paths should give the same outputs (up to float
+# rounding) and the same winning secondary capsules:
+caps2_norm = np.linalg.norm(np.squeeze(caps2_output), axis=-1)
+caps2_norm_xla = np.linalg.norm(np.squeeze(caps2_output_xla), axis=-1)
+max_abs_diff = np.max(np.abs(caps2_output - caps2_output_xla))
+same_ranking = np.mean(np.argsort(caps2_norm, axis=-1) == np.argsort(caps2_norm_xla, axis=-1))
+
+print('-------------------------------------------------------')
+print('Max abs difference of caps2 outputs: %.2e' % max_abs_diff)
+print('Fraction of identical caps2 rankings: %.4f' % same_ranking)
+print('Without XLA: %.2f ms per batch' % (duration*1000))
+print('With XLA: %.2f ms per batch' % (duration_xla*1000))
+print('Speedup: %.2f' % (duration / duration_xla))
+
+
+print('... Finished XLA benchmark!')
+print('-------------------------------------------------------')
@@ -7,8 +7,11 @@ This code includes all relevant functions for setting up the capsule network
 and some additional helper functions.
 
 It is including:
-    save_params, plot_results,
-    squash, safe_norm, routing_by_agreement,
+    save_params, plot_results, group_crowding_predictions, quantize_int8,
+    fake_quantize_checkpoint, prune_checkpoint, write_checkpoint,
+    squash, safe_norm, routing_by_agreement, chunked_routing_by_agreement,
+    conv_caps_routing,
+    recompute_grad,
     conv_layers, primary_caps_layer, secondary_caps_layer,
     predict_shapelabels, create_masked_decoder_input,
     compute_margin_loss, compute_accuracy, compute_reconstruction,
@@ -115,6 +118,241 @@ def plot_uncrowding_results(results, categories, n_idx, save=None):
         plt.savefig(save)
         plt.close()
 
+def group_crowding_predictions(predictions, n_categories, n_idx, routing_max=None):
+    '''
+    Group the outputs of a single prediction pass over all test files (see
+    crowding_input_fn in capser_input_fn.py) by their category and test
+    condition on the fly
+    
+    Parameters
+    ----------
+    predictions: generator
+                 Output of Estimator.predict including the tags category_idx
+                 and stim_idx
+    n_categories: int
+                  Number of test stimulus categories
+    n_idx: int
+           Number of test conditions that were used
+    routing_max: int
+                 If not None, group the results after every routing iteration
+                 up to routing_max in the same pass (see the *_iters outputs
+                 in capser_model_fn.py). Then, all returned results except
+                 n_samples get an additional first dimension for the routing
+                 iterations
+    
+    Returns
+    -------
+    vernier_accuracy: 2d array
+                      Vernier accuracy for each category and test condition
+    rank_pred_shapes: 2d list of arrays
+                      All shape types that were ranked for each category and
+                      test condition
+    rank_pred_proba: 3d array
+                     Mean ranking probabilities for each category and test
+                     condition
+    n_samples: 2d array
+               Number of test samples used for each category and test condition
+    '''
+    n_routing = 1 if routing_max is None else routing_max
+    n_samples = np.zeros(shape=(n_categories, n_idx))
+    n_correct = np.zeros(shape=(n_routing, n_categories, n_idx))
+    sum_proba = None
+    rank_pred_shapes = [[[set() for stim_idx in range(n_idx)] for n_category in range(n_categories)]
+                        for idx_routing in range(n_routing)]
+    for p in predictions:
+        if routing_max is None:
+            vernier_correct = [p['vernier_correct']]
+            rank_pred_shapes_iters = [p['rank_pred_shapes']]
+            rank_pred_proba_iters = [p['rank_pred_proba']]
+        else:
+            vernier_correct = p['vernier_correct_iters']
+            rank_pred_shapes_iters = p['rank_pred_shapes_iters']
+            rank_pred_proba_iters = p['rank_pred_proba_iters']
+        n_category, stim_idx = p['category_idx'], p['stim_idx']
+        n_samples[n_category, stim_idx] += 1
+        n_correct[:, n_category, stim_idx] += vernier_correct
+        if sum_proba is None:
+            sum_proba = np.zeros(shape=(n_routing, n_categories, n_idx, len(rank_pred_proba_iters[0])))
+        sum_proba[:, n_category, stim_idx, :] += rank_pred_proba_iters
+        for idx_routing in range(n_routing):
+            rank_pred_shapes[idx_routing][n_category][stim_idx].update(rank_pred_shapes_iters[idx_routing])
+
+    vernier_accuracy = n_correct / n_samples
+    rank_pred_shapes = [[[np.unique(list(shapes)) for shapes in category] for category in routing]
+                        for routing in rank_pred_shapes]
+    rank_pred_proba = sum_proba / n_samples[:, :, np.newaxis]
+    if routing_max is None:
+        return vernier_accuracy[0], rank_pred_shapes[0], rank_pred_proba[0], n_samples
+    return vernier_accuracy, rank_pred_shapes, rank_pred_proba, n_samples
+
+
+def quantize_int8(weights, axis=-1):
+    '''
+    Symmetric post-training quantization of weights to int8 with one scale
+    for each slice along the given axis (e.g. for each output channel)
+    
+    Parameters
+    ----------
+    weights: array
+             Float weights
+    axis: int
+          Axis with separate scales (all other axes share a scale)
+    
+    Returns
+    -------
+    weights_int8: array
+                  Quantized weights (dequantize with weights_int8 * scales)
+    scales: array
+            Scales with the same number of dimensions as the weights
+    '''
+    reduce_axes = tuple(ax for ax in range(weights.ndim) if ax != axis % weights.ndim)
+    max_abs = np.max(np.abs(weights), axis=reduce_axes, keepdims=True)
+    scales = np.where(max_abs > 0, max_abs / 127., 1.).astype(np.float32)
+    weights_int8 = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+    return weights_int8, scales
+
+
+def fake_quantize_checkpoint(checkpoint, save_dir):
+    '''
+    Fake-quantize the conv kernels, the transformation matrices W of the
+    secondary capsules and the decoder kernels of a trained network to int8.
+    The int8 weights and their scales are saved in save_dir/weights_int8.npz,
+    and a checkpoint with the dequantized float32 weights is saved in save_dir,
+    so that the accuracy of the int8 weights can be tested with the usual
+    Estimator (with float kernels). All other variables (biases, batch norm)
+    stay in float, the optimizer slots are dropped.
+    
+    Parameters
+    ----------
+    checkpoint: str
+                Path of the checkpoint of the trained network
+    save_dir: str
+              Directory for the quantized network
+    
+    Returns
+    -------
+    n_bytes_float: int
+                   Size of all inference weights in float32
+    n_bytes_int8: int
+                  Size of all inference weights after quantization
+    '''
+    reader = tf.train.load_checkpoint(checkpoint)
+    variable_names = sorted(reader.get_variable_to_shape_map().keys())
+    variable_names = [name for name in variable_names if 'Adam' not in name and not name.endswith('_power')]
+
+    n_bytes_float, n_bytes_int8 = 0, 0
+    values, weights_int8 = {}, {}
+    for name in variable_names:
+        value = reader.get_tensor(name)
+        n_bytes_float += value.nbytes
+        if name.endswith('/kernel') or name.endswith('/W'):
+            # W has one scale per primary capsule, kernels per output channel:
+            axis = 1 if name.endswith('/W') else -1
+            value_int8, scales = quantize_int8(value, axis)
+            weights_int8[name] = value_int8
+            weights_int8[name + '/scales'] = scales
+            value = value_int8 * scales
+            n_bytes_int8 += value_int8.nbytes + scales.nbytes
+        else:
+            n_bytes_int8 += value.nbytes
+        values[name] = value
+
+    write_checkpoint(values, save_dir)
+    np.savez_compressed(save_dir + '/weights_int8.npz', **weights_int8)
+    return n_bytes_float, n_bytes_int8
+
+
+def prune_checkpoint(checkpoint, save_dir, keep_conv1, keep_conv2, keep_maps, parameters):
+    '''
+    Remove conv filters and primary capsule maps from a trained network and
+    save the smaller network in save_dir. The network has to be used with
+    the adjusted conv_params, caps1_nmaps and caps1_ncaps afterwards. Since
+    the conv reconstruction decoder mirrors the conv layers, its variables
+    are dropped, so the pruned network is meant for inference without
+    reconstructions. The optimizer slots are dropped as well.
+    
+    Parameters
+    ----------
+    checkpoint: str
+                Path of the checkpoint of the trained network
+    save_dir: str
+              Directory for the pruned network
+    keep_conv1, keep_conv2: list
+                            Indices of the remaining filters of conv1 and conv2
+    keep_maps: list
+               Indices of the remaining primary capsule maps
+    parameters: flags
+                Contains all parameters defined in parameters.py (of the
+                unpruned network)
+    
+    Returns
+    -------
+    n_params: int
+              Number of parameters of the remaining variables before pruning
+    n_params_pruned: int
+                     Number of parameters of the remaining variables after
+                     pruning
+    '''
+    # The primary capsules are ordered position by position with the maps as
+    # innermost dimension, and each map has caps1_ndims conv3 filters:
+    keep_conv3 = [idx_map*parameters.caps1_ndims + idx_dim for idx_map in keep_maps
+                  for idx_dim in range(parameters.caps1_ndims)]
+
+    reader = tf.train.load_checkpoint(checkpoint)
+    n_params, n_params_pruned = 0, 0
+    values = {}
+    for name in reader.get_variable_to_shape_map().keys():
+        if 'Adam' in name or name.endswith('_power'):
+            continue
+        if parameters.rec_decoder_type=='conv' and ('upsampled_reconstruction' in name or
+                                                    name.startswith('reconstructed_output/')):
+            continue
+
+        value = reader.get_tensor(name)
+        n_params += value.size
+        if name.startswith('conv1/') or name.startswith('conv1_bn/'):
+            value = value[..., keep_conv1]
+        elif name.startswith('conv2/') or name.startswith('conv2_bn/'):
+            if name=='conv2/kernel':
+                value = value[:, :, keep_conv1, :]
+            value = value[..., keep_conv2]
+        elif name.startswith('conv3/'):
+            if name=='conv3/kernel':
+                value = value[:, :, keep_conv2, :]
+            value = value[..., keep_conv3]
+        elif name.endswith('/W'):
+            # W has one matrix per primary capsule, per map (share_W) or per
+            # map and window position (conv_caps), always with the maps as
+            # innermost dimension:
+            value = value[:, [idx_caps for idx_caps in range(value.shape[1]) if idx_caps % parameters.caps1_nmaps in keep_maps]]
+        n_params_pruned += value.size
+        values[name] = value
+    write_checkpoint(values, save_dir)
+    return n_params, n_params_pruned
+
+
+def write_checkpoint(values, save_dir):
+    '''
+    Save variable values in a new checkpoint that can be restored by the
+    Estimator
+    
+    Parameters
+    ----------
+    values: dict
+            Values of all variables (by name)
+    save_dir: str
+              Directory for the checkpoint
+    '''
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    with tf.Graph().as_default():
+        variables = {name: tf.Variable(value) for name, value in values.items()}
+        saver = tf.train.Saver(variables)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            saver.save(sess, save_dir + '/model.ckpt', global_step=values.get('global_step'))
+
 
 ################################
 #      Squash function:        #
@@ -181,7 +419,7 @@ def safe_norm(s, axis=-1, epsilon=1e-7, keepdims=False, name=None):
 ################################
 #     Routing by agreement:    #
 ################################
-def routing_by_agreement(caps2_predicted, batch_size, iter_routing, parameters):
+def routing_by_agreement(caps2_predicted, batch_size, iter_routing, parameters, caps1_sample_idx=None):
     '''
     Implementation of routing by agreement
     
@@ -195,44 +433,431 @@ def routing_by_agreement(caps2_predicted, batch_size, iter_routing, parameters):
                   Contains the number of routing iterations
     parameters: flags
                 Contains all parameters defined in parameters.py
+    caps1_sample_idx: tensor
+                      If not None, caps2_predicted only contains the predictions
+                      of the active primary capsules with shape [n_active,
+                      caps2_ncaps, caps2_ndims] and caps1_sample_idx contains
+                      the sample index for each of them
     
     Returns
     -------
-    caps2_output
+    caps2_output: tensor
+                  Secondary capsule output
+    n_iter_routing: tensor
+                    Number of routing iterations used for each sample
+    caps2_output_iters: tensor
+                        Secondary capsule output after each routing iteration
+                        with shape [iter_routing, batch_size, 1, caps2_ncaps,
+                        caps2_ndims, 1]
     '''
     
-    # Stop routing after selected number of routing iterations:
-    def routing_condition(raw_weights, caps2_output, counter):
-        output = tf.less(counter, iter_routing)
+    # Stop routing after selected number of routing iterations (without the final
+    # iteration for routing_stop_gradient, see below) or, for adaptive routing,
+    # as soon as the routing converged for all samples:
+    n_iter_loop = iter_routing - 1 if parameters.routing_stop_gradient else iter_routing
+    def routing_condition(raw_weights, caps2_output, counter, n_iter_routing, active, caps2_output_iters):
+        output = tf.logical_and(tf.less(counter, n_iter_loop), tf.reduce_any(active))
         return output
     
+    # Sparse routing (only active primary capsules and/or top-k parents): the
+    # routing is computed on a list of primary capsules with their predictions
+    # for the chosen parents [n_caps1, n_parents, caps2_ndims]:
+    sparse_routing = parameters.routing_top_k or caps1_sample_idx is not None
+    if sparse_routing:
+        if caps1_sample_idx is None:
+            n_caps1 = caps2_predicted.get_shape()[1].value
+            caps2_predicted = tf.reshape(caps2_predicted, [-1, parameters.caps2_ncaps, parameters.caps2_ndims])
+            caps1_sample_idx = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch_size), -1), [1, n_caps1]), [-1])
+        parents_idx = tf.zeros_like(caps2_predicted[:, :, 0], dtype=tf.int32) + tf.range(parameters.caps2_ncaps)
+        
+        # Top-k sparse routing: each primary capsule only routes to the k
+        # secondary capsules with the largest predictions:
+        if parameters.routing_top_k:
+            caps2_predicted_norm = safe_norm(caps2_predicted, axis=-1, name='caps2_predicted_norm')
+            _, parents_idx = tf.nn.top_k(caps2_predicted_norm, parameters.routing_top_k, name='top_k_idx')
+            caps2_predicted = tf.batch_gather(caps2_predicted, parents_idx)
+        
+        # Position of the chosen parents in the flattened caps2 outputs [batch*caps2_ncaps, caps2_ndims]:
+        parents_idx = tf.add(tf.expand_dims(caps1_sample_idx, -1)*parameters.caps2_ncaps, parents_idx, name='parents_idx')
+    
+    # Else, we use the layout [batch, caps2_ncaps, caps1_ncaps, caps2_ndims]
+    # for the predictions. Like this, the weighted sum over the primary capsules
+    # and the agreement with each secondary capsule are both single matmuls
+    # that are batched over the samples and secondary capsules (without tiling
+    # caps2_output for each primary capsule):
+    else:
+        caps2_predicted = tf.transpose(tf.squeeze(caps2_predicted, -1), [0, 2, 1, 3], name='caps2_predicted_transposed')
+
     # Body that defines the routing:
-    def routing_body(raw_weights, caps2_output, counter):
-        routing_weights = tf.nn.softmax(raw_weights, axis=2, name='routing_weights')
-        weighted_predictions = tf.multiply(routing_weights, caps2_predicted, name='weighted_predictions')
-        weighted_sum = tf.reduce_sum(weighted_predictions, axis=1, keepdims=True, name='weighted_sum')
-        
-        # Hint: we are not using the caps2_output passed as input but calculate
-        # it here but we need to have the same inputs/outputs for the routing body.
-        caps2_output = squash(weighted_sum, axis=-2, name='caps2_output')
-        caps2_output_tiled = tf.tile(caps2_output, [1, parameters.caps1_ncaps, 1, 1, 1], name='caps2_output_tiled')
-        agreement = tf.matmul(caps2_predicted, caps2_output_tiled, transpose_a=True, name='agreement')
-        raw_weights = tf.add(raw_weights, agreement, name='raw_weights')
-        return raw_weights, caps2_output, tf.add(counter, 1)
+    def routing_body(raw_weights, caps2_output, counter, n_iter_routing, active, caps2_predicted=caps2_predicted):
+        if sparse_routing:
+            # raw_weights: [n_caps1, n_parents]
+            routing_weights = tf.nn.softmax(raw_weights, axis=-1, name='routing_weights')
+            weighted_predictions = tf.multiply(tf.expand_dims(routing_weights, -1), caps2_predicted,
+                                               name='weighted_predictions')
+            weighted_sum = tf.unsorted_segment_sum(weighted_predictions, parents_idx, batch_size*parameters.caps2_ncaps)
+            weighted_sum = tf.reshape(weighted_sum, [-1, parameters.caps2_ncaps, 1, parameters.caps2_ndims],
+                                      name='weighted_sum')
+        else:
+            # raw_weights: [batch, caps2_ncaps, 1, caps1_ncaps]
+            routing_weights = tf.nn.softmax(raw_weights, axis=1, name='routing_weights')
+            weighted_sum = tf.matmul(routing_weights, caps2_predicted, name='weighted_sum')
+        
+        # Hint: the caps2_output passed as input is only used to check for
+        # convergence in the adaptive routing.
+        caps2_output_new = squash(weighted_sum, axis=-1, name='caps2_output')
+        if sparse_routing:
+            caps2_output_parents = tf.gather(tf.reshape(caps2_output_new, [-1, parameters.caps2_ndims]), parents_idx)
+            agreement = tf.reduce_sum(caps2_predicted * caps2_output_parents, axis=-1, name='agreement')
+        else:
+            agreement = tf.matmul(caps2_output_new, caps2_predicted, transpose_b=True, name='agreement')
+        raw_weights_new = tf.add(raw_weights, agreement, name='raw_weights')
+        n_iter_routing = tf.add(n_iter_routing, tf.cast(active, tf.int32))
+        
+        if parameters.adaptive_routing:
+            # Samples that converged keep their routing weights and outputs:
+            caps2_output_delta = tf.reduce_max(tf.abs(caps2_output_new - caps2_output), axis=[1, 2, 3])
+            if sparse_routing:
+                raw_weights_new = tf.where(tf.gather(active, caps1_sample_idx), raw_weights_new, raw_weights)
+            else:
+                raw_weights_new = tf.where(active, raw_weights_new, raw_weights)
+            caps2_output_new = tf.where(active, caps2_output_new, caps2_output)
+            active = tf.logical_and(active, tf.greater(caps2_output_delta, parameters.routing_tolerance))
+        return raw_weights_new, caps2_output_new, tf.add(counter, 1), n_iter_routing, active
     
     # Execution of routing via while-loop:
     with tf.name_scope('Routing_by_agreement'):
         # Initialize weights and caps2-output-array
-        raw_weights = tf.zeros([batch_size, parameters.caps1_ncaps, parameters.caps2_ncaps, 1, 1],
-                               dtype=tf.float32, name='raw_weights')
-        caps2_output = tf.zeros([batch_size, 1, parameters.caps2_ncaps, parameters.caps2_ndims, 1],
+        if sparse_routing:
+            raw_weights = tf.zeros_like(caps2_predicted[:, :, 0], name='raw_weights')
+        else:
+            raw_weights = tf.zeros([batch_size, parameters.caps2_ncaps, 1, caps2_predicted.get_shape()[2].value],
+                                   dtype=tf.float32, name='raw_weights')
+        caps2_output = tf.zeros([batch_size, parameters.caps2_ncaps, 1, parameters.caps2_ndims],
+                                dtype=tf.float32, name='caps2_output_init')
+        
+        # Counter for number of routing iterations (overall and per sample) and
+        # samples for which the routing did not converge yet:
+        counter = tf.constant(0)
+        n_iter_routing = tf.zeros([batch_size], dtype=tf.int32, name='n_iter_routing_init')
+        active = tf.fill([batch_size], True, name='active_init')
+        
+        # Collect the caps2 outputs after every routing iteration, so that all
+        # iterations can be evaluated in a single forward pass:
+        caps2_output_iters = tf.TensorArray(tf.float32, size=0, dynamic_size=True, name='caps2_output_iters')
+        
+        # Optionally, gradients only flow through the final routing iteration.
+        # All previous iterations run on the predictions without gradients, so
+        # they do not need to be stored for the backward pass:
+        if parameters.routing_stop_gradient:
+            caps2_predicted_loop = tf.stop_gradient(caps2_predicted, name='caps2_predicted_no_gradient')
+        else:
+            caps2_predicted_loop = caps2_predicted
+        
+        # Optionally, only the loop variables are stored for each routing
+        # iteration and the intermediates of an iteration get recomputed
+        # during backprop (see routing_recompute):
+        if parameters.routing_recompute:
+            routing_step = lambda *loop_vars: recompute_grad(
+                    lambda caps2_predicted, *loop_vars: routing_body(*loop_vars, caps2_predicted=caps2_predicted),
+                    caps2_predicted_loop, *loop_vars)
+        else:
+            routing_step = lambda *loop_vars: routing_body(*loop_vars, caps2_predicted=caps2_predicted_loop)
+        
+        # The caps2 outputs of every iteration are collected outside of the
+        # routing step, since the TensorArray is no tensor that can be passed
+        # to recompute_grad:
+        def routing_body_loop(raw_weights, caps2_output, counter, n_iter_routing, active, caps2_output_iters):
+            raw_weights, caps2_output, counter_new, n_iter_routing, active = routing_step(
+                    raw_weights, caps2_output, counter, n_iter_routing, active)
+            caps2_output_iters = caps2_output_iters.write(counter, caps2_output)
+            return raw_weights, caps2_output, counter_new, n_iter_routing, active, caps2_output_iters
+        
+        raw_weights, caps2_output, counter, n_iter_routing, active, caps2_output_iters = tf.while_loop(
+                routing_condition, routing_body_loop,
+                [raw_weights, caps2_output, counter, n_iter_routing, active, caps2_output_iters])
+        
+        # Final, differentiable iteration (samples that already converged in
+        # the adaptive routing do one more iteration to get gradients as well):
+        if parameters.routing_stop_gradient:
+            raw_weights, caps2_output, counter, n_iter_routing, _ = routing_body(
+                    raw_weights, caps2_output, counter, n_iter_routing, tf.fill([batch_size], True))
+            caps2_output_iters = caps2_output_iters.write(counter - 1, caps2_output)
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('n_iter_routing', n_iter_routing)
+        
+        # If the adaptive routing stopped early, the outputs of the remaining
+        # iterations are the final outputs:
+        caps2_output_iters = tf.concat([caps2_output_iters.stack(),
+                                        tf.tile(tf.expand_dims(caps2_output, 0), [iter_routing - counter, 1, 1, 1, 1])], 0)
+        
+        # Back to the usual layout [batch, 1, caps2_ncaps, caps2_ndims, 1]:
+        caps2_output = tf.reshape(caps2_output, [-1, 1, parameters.caps2_ncaps, parameters.caps2_ndims, 1],
+                                  name='caps2_output')
+        caps2_output_iters = tf.reshape(caps2_output_iters, [iter_routing, -1, 1, parameters.caps2_ncaps,
+                                                             parameters.caps2_ndims, 1], name='caps2_output_iters')
+        return caps2_output, n_iter_routing, caps2_output_iters
+
+
+def chunked_routing_by_agreement(caps1_output, W, batch_size, iter_routing, parameters):
+    '''
+    Implementation of routing by agreement that processes the primary capsules
+    in chunks (see parameters.py: routing_chunk_size). The predictions for the
+    secondary capsules and the raw weights are computed on the fly for each
+    chunk, so they never exist for all primary capsules at once. In the
+    backward pass, they get recomputed for each chunk as well. The raw weights
+    of a primary capsule are its summed agreements with the caps2 outputs of
+    all previous iterations, so they are computed from the sum of these caps2
+    outputs. The results differ from routing_by_agreement only by the float
+    summation order. The deviation is as large as the float32 rounding error of
+    routing_by_agreement itself (~5e-7 for caps2 outputs with norms close to
+    1, see compare_chunked_routing.py)
+    
+    Parameters
+    ----------
+    caps1_output: tensor
+                  Primary capsule outputs
+    W: tensor
+       Weights with shape [caps1_ncaps, caps2_ncaps*caps2_ndims, caps1_ndims]
+    batch_size: tensor
+                Contains the batch size
+    iter_routing: tensor
+                  Contains the number of routing iterations
+    parameters: flags
+                Contains all parameters defined in parameters.py
+    
+    Returns
+    -------
+    caps2_output: tensor
+                  Secondary capsule output
+    n_iter_routing: tensor
+                    Number of routing iterations used for each sample
+    caps2_output_iters: tensor
+                        Secondary capsule output after each routing iteration
+    '''
+    if parameters.routing_top_k or parameters.routing_stop_gradient or parameters.routing_recompute:
+        raise SystemExit('\nChunked routing does not support routing_top_k, routing_stop_gradient and routing_recompute '
+                         '(the chunks always get recomputed during backprop)!\n')
+    
+    chunk_size = parameters.routing_chunk_size
+    n_chunks = -(-parameters.caps1_ncaps // chunk_size)
+    caps1_output_transposed = tf.transpose(caps1_output, [1, 2, 0], name='caps1_output_transposed')
+    
+    # Stop routing after selected number of routing iterations or, for adaptive
+    # routing, as soon as the routing converged for all samples:
+    def routing_condition(caps2_output_sum, caps2_output, counter, n_iter_routing, active, caps2_output_iters):
+        output = tf.logical_and(tf.less(counter, iter_routing), tf.reduce_any(active))
+        return output
+    
+    # Weighted predictions of a chunk of primary capsules, summed over the
+    # chunk. The raw weights of the chunk are the agreements of its predictions
+    # with the summed caps2 outputs of all previous iterations:
+    def chunk_weighted_sum(W, caps1_output_transposed, caps2_output_sum, idx_chunk):
+        chunk_start = idx_chunk*chunk_size
+        chunk_end = tf.minimum(chunk_start + chunk_size, parameters.caps1_ncaps)
+        
+        # caps2_predicted_chunk: [chunk_size, batch, caps2_ncaps, caps2_ndims]
+        caps2_predicted_chunk = tf.matmul(W[chunk_start:chunk_end], caps1_output_transposed[chunk_start:chunk_end])
+        caps2_predicted_chunk = tf.reshape(tf.transpose(caps2_predicted_chunk, [0, 2, 1]),
+                                           [-1, batch_size, parameters.caps2_ncaps, parameters.caps2_ndims])
+        raw_weights_chunk = tf.reduce_sum(caps2_predicted_chunk * caps2_output_sum, axis=-1, name='raw_weights')
+        routing_weights = tf.nn.softmax(raw_weights_chunk, axis=-1, name='routing_weights')
+        return (tf.reduce_sum(tf.expand_dims(routing_weights, -1) * caps2_predicted_chunk, axis=0),)
+    
+    # Body that defines the routing. First, the caps2 outputs of the last
+    # iteration are added to the summed caps2 outputs (for the first iteration,
+    # caps2_output is zero). Then, the weighted predictions of all chunks are
+    # added to the weighted sum:
+    def routing_body(caps2_output_sum, caps2_output, counter, n_iter_routing, active, caps2_output_iters):
+        # Samples that converged in the adaptive routing keep their routing weights:
+        active_mask = tf.reshape(tf.cast(active, tf.float32), [-1, 1, 1])
+        caps2_output_sum = tf.add(caps2_output_sum, caps2_output*active_mask, name='caps2_output_sum')
+        
+        def chunk_condition(idx_chunk, weighted_sum):
+            return tf.less(idx_chunk, n_chunks)
+        
+        # The chunks are processed one after the other to bound the memory.
+        # Only the inputs of each chunk are stored for the backward pass, its
+        # predictions and raw weights get recomputed (see recompute_grad):
+        def chunk_body(idx_chunk, weighted_sum):
+            weighted_sum_chunk = recompute_grad(chunk_weighted_sum, W, caps1_output_transposed, caps2_output_sum,
+                                                idx_chunk)[0]
+            return tf.add(idx_chunk, 1), weighted_sum + weighted_sum_chunk
+        
+        _, weighted_sum = tf.while_loop(chunk_condition, chunk_body, [tf.constant(0), tf.zeros_like(caps2_output)],
+                                        parallel_iterations=1)
+        caps2_output_new = squash(weighted_sum, axis=-1, name='caps2_output')
+        n_iter_routing = tf.add(n_iter_routing, tf.cast(active, tf.int32))
+        
+        if parameters.adaptive_routing:
+            # Samples that converged keep their outputs:
+            caps2_output_delta = tf.reduce_max(tf.abs(caps2_output_new - caps2_output), axis=[1, 2])
+            caps2_output_new = tf.where(active, caps2_output_new, caps2_output)
+            active = tf.logical_and(active, tf.greater(caps2_output_delta, parameters.routing_tolerance))
+        caps2_output_iters = caps2_output_iters.write(counter, caps2_output_new)
+        return caps2_output_sum, caps2_output_new, tf.add(counter, 1), n_iter_routing, active, caps2_output_iters
+    
+    # Execution of routing via while-loop:
+    with tf.name_scope('Chunked_routing_by_agreement'):
+        # Initialize the summed caps2 outputs and the caps2-output-array
+        # [batch, caps2_ncaps, caps2_ndims]:
+        caps2_output_sum = tf.zeros([batch_size, parameters.caps2_ncaps, parameters.caps2_ndims],
+                                    dtype=tf.float32, name='caps2_output_sum')
+        caps2_output = tf.zeros([batch_size, parameters.caps2_ncaps, parameters.caps2_ndims],
                                 dtype=tf.float32, name='caps2_output_init')
         
-        # Counter for number of routing iterations:
+        # Counter for number of routing iterations (overall and per sample) and
+        # samples for which the routing did not converge yet:
         counter = tf.constant(0)
-        raw_weights, caps2_output, counter = tf.while_loop(routing_condition, routing_body,
-                                                           [raw_weights, caps2_output, counter])
-        return caps2_output
+        n_iter_routing = tf.zeros([batch_size], dtype=tf.int32, name='n_iter_routing_init')
+        active = tf.fill([batch_size], True, name='active_init')
+        
+        # Collect the caps2 outputs after every routing iteration, so that all
+        # iterations can be evaluated in a single forward pass:
+        caps2_output_iters = tf.TensorArray(tf.float32, size=0, dynamic_size=True, name='caps2_output_iters')
+        caps2_output_sum, caps2_output, counter, n_iter_routing, active, caps2_output_iters = tf.while_loop(
+                routing_condition, routing_body,
+                [caps2_output_sum, caps2_output, counter, n_iter_routing, active, caps2_output_iters])
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('n_iter_routing', n_iter_routing)
+        
+        # If the adaptive routing stopped early, the outputs of the remaining
+        # iterations are the final outputs:
+        caps2_output_iters = tf.concat([caps2_output_iters.stack(),
+                                        tf.tile(tf.expand_dims(caps2_output, 0), [iter_routing - counter, 1, 1, 1])], 0)
+        
+        # Back to the usual layout [batch, 1, caps2_ncaps, caps2_ndims, 1]:
+        caps2_output = tf.reshape(caps2_output, [-1, 1, parameters.caps2_ncaps, parameters.caps2_ndims, 1],
+                                  name='caps2_output')
+        caps2_output_iters = tf.reshape(caps2_output_iters, [iter_routing, -1, 1, parameters.caps2_ncaps,
+                                                             parameters.caps2_ndims, 1], name='caps2_output_iters')
+        return caps2_output, n_iter_routing, caps2_output_iters
+
+
+def conv_caps_routing(caps1_output, W, batch_size, iter_routing, parameters):
+    '''
+    Implementation of convolutional routing by agreement (see parameters.py:
+    conv_caps). The secondary capsules are computed at every position of a
+    window that is moved over the grid of primary capsules. Each of them only
+    routes from the primary capsules within its window, using weights that
+    are shared across all windows, so memory and compute grow linearly with
+    the image size and the number of weights is independent of it. The
+    routing weights of each primary capsule are normalized over the secondary
+    capsules of each window. Finally, each secondary capsule takes its output
+    from the window in which it is most active (largest norm), so the heads
+    get the usual secondary capsule outputs
+    
+    Parameters
+    ----------
+    caps1_output: tensor
+                  Primary capsule outputs
+    W: tensor
+       Shared weights with shape [conv_caps_kernel**2 * caps1_nmaps,
+       caps2_ncaps*caps2_ndims, caps1_ndims]
+    batch_size: int or tensor
+                Batch size (can be dynamic, e.g. tf.shape(images)[0])
+    iter_routing: int
+                  Number of routing iterations
+    parameters: flags
+                Contains all parameters defined in parameters.py
+    
+    Returns
+    -------
+    caps2_output: tensor
+                  Secondary capsule output
+    n_iter_routing: tensor
+                    Number of routing iterations used for each sample
+    caps2_output_iters: tensor
+                        Secondary capsule output after each routing iteration
+    '''
+    if parameters.routing_chunk_size or parameters.caps1_threshold:
+        raise SystemExit('\nConvolutional capsules do not support routing_chunk_size and caps1_threshold!\n')
+    
+    kernel, stride = parameters.conv_caps_kernel, parameters.conv_caps_stride
+    caps1_grid = [int(n_positions) for n_positions in parameters.caps1_grid]
+    if min(caps1_grid) < kernel:
+        raise SystemExit('\nThe grid of primary capsules ' + str(caps1_grid) + ' is smaller than conv_caps_kernel (' +
+                         str(kernel) + ')!\n')
+    n_window_caps = kernel**2 * parameters.caps1_nmaps
+    n_positions = ((caps1_grid[0] - kernel) // stride + 1) * ((caps1_grid[1] - kernel) // stride + 1)
+    
+    # For each secondary capsule, take the output of the window in which it is
+    # most active: [n, n_positions, caps2_ncaps, caps2_ndims] -> [n, caps2_ncaps, 1, caps2_ndims]
+    def pool_positions(caps2_output):
+        caps2_output = tf.reshape(caps2_output, [-1, n_positions, parameters.caps2_ncaps, parameters.caps2_ndims])
+        caps2_output = tf.transpose(caps2_output, [0, 2, 1, 3])
+        idx_position = tf.argmax(safe_norm(caps2_output, axis=-1), axis=-1, output_type=tf.int32)
+        return tf.batch_gather(caps2_output, tf.expand_dims(idx_position, -1))
+    
+    with tf.name_scope('Conv_caps_routing'):
+        # Primary capsules of all windows [batch*n_positions, n_window_caps,
+        # caps1_ndims]. The patches are ordered by row, column and channel, so
+        # the maps stay the innermost dimension (see primary_caps_layer):
+        caps1_output_grid = tf.reshape(caps1_output, [-1, caps1_grid[0], caps1_grid[1],
+                                                      parameters.caps1_nmaps*parameters.caps1_ndims])
+        caps1_windows = tf.extract_image_patches(caps1_output_grid, ksizes=[1, kernel, kernel, 1],
+                                                 strides=[1, stride, stride, 1], rates=[1, 1, 1, 1], padding='VALID')
+        caps1_windows = tf.reshape(caps1_windows, [-1, n_window_caps, parameters.caps1_ndims], name='caps1_windows')
+        
+        # Predictions of the primary capsules of each window for the secondary
+        # capsules of this window (same batched matmul as in secondary_caps_layer):
+        caps1_windows_transposed = tf.transpose(caps1_windows, [1, 2, 0], name='caps1_windows_transposed')
+        caps2_predicted = tf.matmul(W, caps1_windows_transposed, name='caps2_predicted_raw')
+        caps2_predicted = tf.transpose(caps2_predicted, [2, 0, 1])
+        caps2_predicted = tf.reshape(caps2_predicted, [-1, n_window_caps, parameters.caps2_ncaps,
+                                                       parameters.caps2_ndims, 1], name='caps2_predicted')
+        
+        # Every window is routed like a separate sample:
+        caps2_output, n_iter_routing, caps2_output_iters = routing_by_agreement(caps2_predicted, batch_size*n_positions,
+                                                                                iter_routing, parameters)
+        
+        # Secondary capsule outputs of the most active windows (the number of
+        # routing iterations of a sample is the one of its slowest window):
+        caps2_output = tf.reshape(pool_positions(caps2_output), [-1, 1, parameters.caps2_ncaps,
+                                                                 parameters.caps2_ndims, 1], name='caps2_output')
+        caps2_output_iters = tf.reshape(pool_positions(caps2_output_iters), [iter_routing, -1, 1, parameters.caps2_ncaps,
+                                                                             parameters.caps2_ndims, 1],
+                                        name='caps2_output_iters')
+        n_iter_routing = tf.reduce_max(tf.reshape(n_iter_routing, [-1, n_positions]), axis=1)
+        return caps2_output, n_iter_routing, caps2_output_iters
+
+
+def recompute_grad(fn, *inputs):
+    '''
+    Apply fn to the inputs without storing the intermediates of fn for the
+    backward pass. Instead, fn gets recomputed during backprop (gradient
+    checkpointing), so only its inputs are stored
+    
+    Parameters
+    ----------
+    fn: function
+        Function of tensors returning a tuple of tensors
+    inputs: tensors
+            Input tensors, gradients are only computed with respect to the
+            float inputs
+    
+    Returns
+    -------
+    outputs: tuple of tensors
+             Outputs of fn(*inputs)
+    '''
+    @tf.custom_gradient
+    def fn_recompute(*inputs):
+        def grad(*output_grads):
+            # Recompute fn on copies of the inputs after the output gradients
+            # are available, so that the gradients are taken within this
+            # (backward) context:
+            with tf.control_dependencies([output_grad for output_grad in output_grads if output_grad is not None]):
+                inputs_copy = [tf.identity(x) for x in inputs]
+            outputs = fn(*inputs_copy)
+            # Only the float outputs that are used further on get gradients:
+            outputs, output_grads = zip(*[(output, output_grad) for output, output_grad in zip(outputs, output_grads)
+                                          if output_grad is not None and output.dtype.is_floating])
+            float_inputs = [x for x in inputs_copy if x.dtype.is_floating]
+            input_grads = iter(tf.gradients(outputs, float_inputs, grad_ys=output_grads))
+            return [next(input_grads) if x.dtype.is_floating else None for x in inputs_copy]
+        return fn(*inputs), grad
+    return fn_recompute(*inputs)
 
 
 ###################################
@@ -268,7 +893,7 @@ def conv_layers(images, parameters, phase=True):
             conv1 = tf.layers.batch_normalization(conv1, training=phase, name='conv1_bn')
         else:
             conv1 = tf.layers.conv2d(images, name='conv1', activation=None, **parameters.conv_params[0])
-        conv1 = tf.nn.elu(conv1)
+        conv1 = tf.nn.elu(conv1, name='conv1_activation')
         # Include dropout? Decide in parameters.py
         if parameters.dropout:
             conv1 = tf.layers.dropout(conv1, rate=.3, training=phase, name='dropout1')
@@ -280,7 +905,7 @@ def conv_layers(images, parameters, phase=True):
             conv2 = tf.layers.batch_normalization(conv2, training=phase, name='conv2_bn')
         else:
             conv2 = tf.layers.conv2d(conv1, name='conv2', activation=None, **parameters.conv_params[1])
-        conv2 = tf.nn.elu(conv2)
+        conv2 = tf.nn.elu(conv2, name='conv2_activation')
         # Include dropout? Decide in parameters.py
         if parameters.dropout:
             conv2 = tf.layers.dropout(conv2, rate=.3, training=phase, name='dropout2')
@@ -291,9 +916,10 @@ def conv_layers(images, parameters, phase=True):
         conv_output_sizes = [conv1.get_shape().as_list(), conv2.get_shape().as_list(), conv3.get_shape().as_list()]
                 
         # Create summaries for visualizations in tensorboard 
-        tf.summary.histogram('conv1_output', conv1)
-        tf.summary.histogram('conv2_output', conv2)
-        tf.summary.histogram('conv3_output', conv3)
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('conv1_output', conv1)
+            tf.summary.histogram('conv2_output', conv2)
+            tf.summary.histogram('conv3_output', conv3)
         return conv_output, conv_output_sizes
 
 
@@ -316,12 +942,13 @@ def primary_caps_layer(conv_output, parameters):
         caps1_reshaped = tf.reshape(conv_output, [-1, parameters.caps1_ncaps, parameters.caps1_ndims], name='caps1_reshaped')
         caps1_output = squash(caps1_reshaped, name='caps1_output')
         caps1_output_norm = safe_norm(caps1_output, axis=-1, keepdims=False, name='caps1_output_norm')
-        tf.summary.histogram('caps1_output_norm', caps1_output_norm)
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('caps1_output_norm', caps1_output_norm)
         return caps1_output
 
 
 def secondary_caps_layer(caps1_output, batch_size, iter_routing, parameters,
-                         W_init=None):
+                         W_init=None, caps1_threshold=0.):
     '''
     Setting up the secondary capsules
     
@@ -329,15 +956,17 @@ def secondary_caps_layer(caps1_output, batch_size, iter_routing, parameters,
     ----------
     caps1_output: tensor
                   Primary capsule outputs
-    batch_size: int
-                Batch size
+    batch_size: int or tensor
+                Batch size (can be dynamic, e.g. tf.shape(images)[0])
     iter_routing: int
                   Number of routing iterations
     parameters: flags
                 Contains all parameters defined in parameters.py
     W_init: obj
-            If None, initialize and repeat weights, else use the weights defined in
-            W_init
+            If None, initialize weights, else use the weights defined in W_init
+    caps1_threshold: float
+                     If >0, primary capsules with output norms below this
+                     threshold are inactive and skipped (meant for inference)
     
     Returns
     -------
@@ -345,34 +974,100 @@ def secondary_caps_layer(caps1_output, batch_size, iter_routing, parameters,
                   Secondary capsule output
     caps2_output_norm: tensor
                        Secondary capsule output norms
+    n_iter_routing: tensor
+                    Number of routing iterations used for each sample
+    caps2_output_iters: tensor
+                        Secondary capsule output after each routing iteration
     '''
     
     with tf.name_scope('3_secondary_caps_layer'):
-        # Initialize and repeat weights for further calculations:
+        # Initialize weights for further calculations. Optionally, all positions
+        # of a primary caps map share their weights, so W is sized by the number
+        # of maps instead of the number of primary capsules. For convolutional
+        # capsules, W holds the weights for all primary capsules of a window:
+        if parameters.conv_caps:
+            W_ncaps = parameters.conv_caps_kernel**2 * parameters.caps1_nmaps
+        elif parameters.share_W:
+            W_ncaps = parameters.caps1_nmaps
+        else:
+            W_ncaps = parameters.caps1_ncaps
         if W_init==None:
             W_init = lambda: tf.random_normal(
-                shape=(1, parameters.caps1_ncaps, parameters.caps2_ncaps, parameters.caps2_ndims, parameters.caps1_ndims),
+                shape=(1, W_ncaps, parameters.caps2_ncaps, parameters.caps2_ndims, parameters.caps1_ndims),
                 stddev=parameters.init_sigma, dtype=tf.float32, seed=parameters.random_seed, name='W_init')
 
         W = tf.Variable(W_init, dtype=tf.float32, name='W')
-        W_tiled = tf.tile(W, [batch_size, 1, 1, 1, 1], name='W_tiled')
 
-        # Create second array by repeating the output of the 1st capsule layer
-        # caps2_ncaps times:
-        caps1_output_expanded = tf.expand_dims(caps1_output, -1, name='caps1_output_expanded')
-        caps1_output_tile = tf.expand_dims(caps1_output_expanded, 2, name='caps1_output_tile')
-        caps1_output_tiled = tf.tile(caps1_output_tile, [1, 1, parameters.caps2_ncaps, 1, 1], name='caps1_output_tiled')
-    
-        # Now multiply these matrices
-        caps2_predicted = tf.matmul(W_tiled, caps1_output_tiled, name='caps2_predicted')
+        W_reshaped = tf.reshape(W, [W_ncaps, parameters.caps2_ncaps*parameters.caps2_ndims,
+                                    parameters.caps1_ndims], name='W_reshaped')
+        if parameters.share_W and not parameters.conv_caps:
+            # The primary capsules are ordered position by position with the
+            # maps as innermost dimension (see primary_caps_layer), so the
+            # weights of all primary capsules are the shared weights tiled
+            # over all positions:
+            W_shared = W_reshaped
+            W_reshaped = tf.tile(W_shared, [parameters.caps1_ncaps // parameters.caps1_nmaps, 1, 1],
+                                 name='W_tiled')
         
-        # Routing by agreement:
-        caps2_output = routing_by_agreement(caps2_predicted, batch_size, iter_routing, parameters)
+        if parameters.conv_caps:
+            # Convolutional routing from local windows of primary capsules:
+            caps2_output, n_iter_routing, caps2_output_iters = conv_caps_routing(caps1_output, W_reshaped, batch_size,
+                                                                                 iter_routing, parameters)
+
+        elif caps1_threshold:
+            # Most primary capsules lie on the blank background and are
+            # (almost) inactive. We only compute the predictions and routing
+            # for the active capsules of all samples [n_active, ...]:
+            caps1_output_norm = safe_norm(caps1_output, axis=-1, name='caps1_output_norm')
+            caps1_active = tf.greater(caps1_output_norm, caps1_threshold, name='caps1_active')
+            caps1_active_idx = tf.where(caps1_active, name='caps1_active_idx')
+            caps1_sample_idx = tf.cast(caps1_active_idx[:, 0], tf.int32)
+            caps1_output_active = tf.gather_nd(caps1_output, caps1_active_idx, name='caps1_output_active')
+            W_active = tf.gather(W_reshaped, caps1_active_idx[:, 1], name='W_active')
+            caps2_predicted = tf.matmul(W_active, tf.expand_dims(caps1_output_active, -1), name='caps2_predicted_raw')
+            caps2_predicted = tf.reshape(caps2_predicted, [-1, parameters.caps2_ncaps, parameters.caps2_ndims],
+                                         name='caps2_predicted')
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('caps1_active_fraction', tf.reduce_mean(tf.cast(caps1_active, tf.float32)))
+            
+            # Routing by agreement:
+            caps2_output, n_iter_routing, caps2_output_iters = routing_by_agreement(caps2_predicted, batch_size, iter_routing,
+                                                                                    parameters, caps1_sample_idx)
+
+        elif parameters.routing_chunk_size:
+            # Routing in chunks of primary capsules, the predictions are computed
+            # on the fly for each chunk to bound the memory:
+            caps2_output, n_iter_routing, caps2_output_iters = chunked_routing_by_agreement(caps1_output, W_reshaped, batch_size,
+                                                                                            iter_routing, parameters)
+
+        else:
+            # Compute the predictions of each primary capsule i for each secondary
+            # capsule j: caps2_predicted[:, i, j] = W[0, i, j] x caps1_output[:, i].
+            # Instead of tiling W and caps1_output for every sample and secondary
+            # capsule, we use a single matmul that is batched over the primary
+            # capsules and multiplies all samples at once:
+            if parameters.share_W:
+                # Convolution-like contraction: the positions of all samples are
+                # stacked and multiplied with the shared weights of each map:
+                caps1_output_maps = tf.reshape(caps1_output, [-1, parameters.caps1_nmaps, parameters.caps1_ndims])
+                caps1_output_transposed = tf.transpose(caps1_output_maps, [1, 2, 0], name='caps1_output_transposed')
+                caps2_predicted = tf.matmul(W_shared, caps1_output_transposed, name='caps2_predicted_raw')
+            else:
+                caps1_output_transposed = tf.transpose(caps1_output, [1, 2, 0], name='caps1_output_transposed')
+                caps2_predicted = tf.matmul(W_reshaped, caps1_output_transposed, name='caps2_predicted_raw')
+            caps2_predicted = tf.transpose(caps2_predicted, [2, 0, 1])
+            caps2_predicted = tf.reshape(caps2_predicted, [-1, parameters.caps1_ncaps, parameters.caps2_ncaps,
+                                                           parameters.caps2_ndims, 1], name='caps2_predicted')
+            
+            # Routing by agreement:
+            caps2_output, n_iter_routing, caps2_output_iters = routing_by_agreement(caps2_predicted, batch_size,
+                                                                                    iter_routing, parameters)
         
         # Compute the norm of the output for each output caps and each instance:
         caps2_output_norm = safe_norm(caps2_output, axis=-2, keepdims=True, name='caps2_output_norm')
-        tf.summary.histogram('caps2_output_norm', caps2_output_norm[0, :, :, :])
-        return caps2_output, caps2_output_norm
+        if parameters.summary_level == 'full':
+            tf.summary.histogram('caps2_output_norm', caps2_output_norm[0, :, :, :])
+        return caps2_output, caps2_output_norm, n_iter_routing, caps2_output_iters
 
 
 ################################
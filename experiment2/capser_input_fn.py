@@ -12,14 +12,63 @@ https://www.tensorflow.org/guide/estimators
 @author: Lynn Schmittwilken
 """
 
+import hashlib
+import numpy as np
 import tensorflow as tf
 from parameters import parameters
 
 
+########################################
+#         Gaussian noise fields:       #
+########################################
+# The noise bank is only drawn once (see noise_bank_dataset):
+noise_bank = []
+
+def gaussian_noise(stddev, seed=None, noise_field=None):
+    # Create a gaussian noise field for one image with the given stddev. If a
+    # seed is given, stateless random ops are used (see parse_tfrecords_test).
+    # With the noise bank, the unit-variance noise_field is served by
+    # noise_bank_dataset and only gets scaled
+    im_shape = [parameters.im_size[0], parameters.im_size[1], parameters.im_depth]
+    if noise_field is not None:
+        noise = noise_field
+    elif seed is None:
+        noise = tf.random_normal(im_shape)
+    else:
+        noise = tf.contrib.stateless.stateless_random_normal(im_shape, seed)
+    return stddev * noise
+
+
+def noise_bank_dataset(seed=None):
+    # Instead of drawing new noise fields for every image, we serve whole fields
+    # of a precomputed bank of unit-variance noise, two different fields per
+    # sample (for shape_1 and shape_2). The bank gets shuffled in every pass,
+    # so that the fields of a sample and of neighbouring samples never overlap
+    # and the noise statistics stay the same. The bank is drawn with a fixed
+    # seed and, for the test set, also shuffled with a fixed seed, so that the
+    # test noise stays the same across prediction passes and processes
+    im_shape = [parameters.im_size[0], parameters.im_size[1], parameters.im_depth]
+    if not noise_bank:
+        noise_bank.append(np.random.RandomState(parameters.noise_bank_seed).normal(
+                size=[parameters.noise_bank_size] + im_shape).astype(np.float32))
+    dataset = tf.data.Dataset.from_tensor_slices(noise_bank[0])
+    dataset = dataset.shuffle(parameters.noise_bank_size, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(2, drop_remainder=True).repeat()
+    
+    # During training, the fields are additionally rolled by a random shift, so
+    # that a field looks different in every pass of the bank:
+    if seed is None:
+        def roll_fields(noise_fields):
+            shift = tf.cast(tf.random_uniform([2]) * [float(im_shape[0]), float(im_shape[1])], tf.int32)
+            return tf.manip.roll(noise_fields, shift, axis=[1, 2])
+        dataset = dataset.map(roll_fields)
+    return dataset.map(lambda noise_fields: (noise_fields[0], noise_fields[1]))
+
+
 ########################################
 #     Parse tfrecords training set:    #
 ########################################
-def parse_tfrecords_train(serialized_data):
+def parse_tfrecords_train(serialized_data, noise_fields=(None, None)):
     with tf.name_scope('Parsing_trainset'):
         # Define a dict with the data-names and types we expect to find in the
         # TFRecords file.
@@ -98,10 +147,8 @@ def parse_tfrecords_train(serialized_data):
         # Add some random gaussian TRAINING noise (always):
         noise1 = tf.random_uniform([1], parameters.train_noise[0], parameters.train_noise[1], tf.float32)
         noise2 = tf.random_uniform([1], parameters.train_noise[0], parameters.train_noise[1], tf.float32)
-        shape_1_images = tf.add(shape_1_images, tf.random_normal(
-                shape=[parameters.im_size[0], parameters.im_size[1], parameters.im_depth], mean=0.0, stddev=noise1))
-        shape_2_images = tf.add(shape_2_images, tf.random_normal(
-                shape=[parameters.im_size[0], parameters.im_size[1], parameters.im_depth], mean=0.0, stddev=noise2))
+        shape_1_images = tf.add(shape_1_images, gaussian_noise(noise1, noise_field=noise_fields[0]))
+        shape_2_images = tf.add(shape_2_images, gaussian_noise(noise2, noise_field=noise_fields[1]))
     
     
         # Adjust brightness and contrast by a random factor
@@ -147,7 +194,7 @@ def parse_tfrecords_train(serialized_data):
 ########################################
 #      Parse tfrecords test set:       #
 ########################################
-def parse_tfrecords_test(serialized_data):
+def parse_tfrecords_test(sample_idx, serialized_data, noise_fields=(None, None)):
     with tf.name_scope('Parsing_testset'):
         # Define a dict with the data-names and types we expect to find in the
         # TFRecords file.
@@ -218,15 +265,18 @@ def parse_tfrecords_test(serialized_data):
         x_shape_2 = tf.reshape(x_shape_2, [1])
         y_shape_2 = tf.reshape(y_shape_2, [1])
     
-        # For the test and validation set, we only add TEST noise
-        noise1 = tf.random_uniform([1], parameters.test_noise[0], parameters.test_noise[1], tf.float32)
-        noise2 = tf.random_uniform([1], parameters.test_noise[0], parameters.test_noise[1], tf.float32)
-        shape_1_images = tf.add(shape_1_images, tf.random_normal(
-                shape=[parameters.im_size[0], parameters.im_size[1], parameters.im_depth], mean=0.0,
-                stddev=noise1))
-        shape_2_images = tf.add(shape_2_images, tf.random_normal(
-                shape=[parameters.im_size[0], parameters.im_size[1], parameters.im_depth], mean=0.0,
-                stddev=noise2))
+        # For the test and validation set, we only add TEST noise.
+        # The noise is drawn with stateless random ops keyed on the sample index
+        # and the test_noise_seed, so that every prediction pass (e.g. for each
+        # network or routing iteration) sees exactly the same noisy stimuli
+        sample_idx = tf.cast(sample_idx, tf.int64)
+        test_noise_seed = tf.constant(parameters.test_noise_seed, tf.int64)
+        seeds = [tf.stack([test_noise_seed, 4*sample_idx + i]) for i in range(4)]
+        noise_range = parameters.test_noise[1] - parameters.test_noise[0]
+        noise1 = parameters.test_noise[0] + noise_range * tf.contrib.stateless.stateless_random_uniform([1], seeds[0])
+        noise2 = parameters.test_noise[0] + noise_range * tf.contrib.stateless.stateless_random_uniform([1], seeds[1])
+        shape_1_images = tf.add(shape_1_images, gaussian_noise(noise1, seeds[2], noise_fields[0]))
+        shape_2_images = tf.add(shape_2_images, gaussian_noise(noise2, seeds[3], noise_fields[1]))
         
         # Clip the pixel values
         shape_1_images = tf.clip_by_value(shape_1_images, parameters.clip_values[0], parameters.clip_values[1])
@@ -236,33 +286,89 @@ def parse_tfrecords_test(serialized_data):
             x_shape_1, y_shape_1, x_shape_2, y_shape_2]
 
 
+###########################
+#      Test dataset:      #
+###########################
+def test_cache_file(filename, parameters):
+    # Name of the cache file for the noisy test stimuli of a test file (see
+    # test_dataset). It contains a hash of all flags that are used to parse
+    # the test stimuli and of the size and modification time of the test file,
+    # so that a stale cache (e.g. after changing the noise or regenerating the
+    # tfrecords file) is never reused:
+    file_stat = tf.gfile.Stat(filename)
+    cache_key = [parameters.im_size, parameters.im_depth, parameters.clip_values, parameters.test_noise,
+                 parameters.test_noise_seed, file_stat.length, file_stat.mtime_nanos]
+    if parameters.noise_bank:
+        cache_key += [parameters.noise_bank_size, parameters.noise_bank_seed]
+    return filename + '_cache_' + hashlib.md5(str(cache_key).encode()).hexdigest()
+
+
+def test_dataset(filename, cache_file, parameters):
+    # Create a TensorFlow Dataset-object for a single test file:
+    dataset = tf.data.TFRecordDataset(filenames=filename, num_parallel_reads=32)
+
+    # Tag each sample with its index which is used as a key for the test
+    # noise (see parse_tfrecords_test). With the noise bank, the noise fields
+    # are served in a fixed order instead:
+    sample_idx = tf.data.Dataset.range(tf.int64.max)
+    if parameters.noise_bank:
+        dataset = tf.data.Dataset.zip((sample_idx, dataset, noise_bank_dataset(parameters.test_noise_seed)))
+    else:
+        dataset = tf.data.Dataset.zip((sample_idx, dataset))
+    dataset = dataset.map(parse_tfrecords_test, num_parallel_calls=64)
+
+    # Since the noisy test stimuli are deterministic, we can cache them and
+    # reuse them in all following prediction passes (see test_cache_file):
+    if parameters.cache_test_data:
+        dataset = dataset.cache(cache_file)
+    return dataset
+
+
 ###########################
 #     Input function:     #
 ###########################
 def input_fn(filenames, stage, parameters, buffer_size=1024):
-    # Create a TensorFlow Dataset-object:
-    dataset = tf.data.TFRecordDataset(filenames=filenames, num_parallel_reads=32)
-    
     # Depending on whether we use the train or test set, different parsing functions
     # are used:
     if stage=='train' or stage=='eval':
+        # The data can be split into several shards (filenames can be a glob).
+        # The shards get shuffled with a deterministic permutation for each
+        # epoch, and are read in parallel:
+        n_shards = len(tf.gfile.Glob(filenames))
+        if n_shards == 0:
+            raise SystemExit('\nPROBLEM: No files found for ' + str(filenames) + ' (see make_tfrecords.py)!\n')
+        shards = tf.data.Dataset.list_files(filenames, shuffle=False)
+        shards = shards.shuffle(buffer_size=n_shards, seed=parameters.shard_seed, reshuffle_each_iteration=True)
+        
+        # Allow for infinite reading of data
+        shards = shards.repeat(parameters.n_epochs)
+        dataset = shards.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TFRecordDataset, cycle_length=n_shards, block_length=1))
+        if parameters.noise_bank:
+            dataset = tf.data.Dataset.zip((dataset, noise_bank_dataset()))
         dataset = dataset.map(parse_tfrecords_train, num_parallel_calls=64)
         
-        # Read a buffer of the given size and randomly shuffle it:
+        # Read a buffer of the given size and randomly shuffle it. Since the
+        # shards are shuffled as well, the buffer can be rather small:
         dataset = dataset.shuffle(buffer_size=buffer_size)
-        
-        # Allow for infinite reading of data
-        num_repeat = parameters.n_epochs
+        num_repeat = 1
+        batch_size = parameters.batch_size
+        drop_remainder = True
 
     else:
-        dataset = dataset.map(parse_tfrecords_test, num_parallel_calls=64)
+        cache_file = test_cache_file(filenames, parameters) if parameters.cache_test_data else ''
+        dataset = test_dataset(filenames, cache_file, parameters)
         
-        # Don't shuffle the data and only go through the it once:
+        # Don't shuffle the data and only go through the it once. The network
+        # works with any batch size, so we use large batches and keep the
+        # last, smaller batch:
         num_repeat = 1
+        batch_size = parameters.predict_batch_size
+        drop_remainder = False
         
     # Repeat the dataset the given number of times and get a batch of data
     dataset = dataset.repeat(num_repeat)
-    dataset = dataset.batch(parameters.batch_size, drop_remainder=True)
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
     
     # Use pipelining to speed up things (see https://www.youtube.com/watch?v=SxOsJPaxHME)
     dataset = dataset.prefetch(2)
@@ -301,15 +407,72 @@ def input_fn(filenames, stage, parameters, buffer_size=1024):
                      'is_training': False}
     return feed_dict, shapelabels
 
+###########################################
+#   Input function for all test files:    #
+###########################################
+def crowding_input_fn(test_filenames, parameters):
+    # Tag each test file with its category and its test condition (stim_idx),
+    # test_filenames[n_category][stim_idx] is the path of the test file:
+    category_idx, stim_idx, filenames, cache_files = [], [], [], []
+    for n_category in range(len(test_filenames)):
+        for n_stim in range(len(test_filenames[n_category])):
+            filename = test_filenames[n_category][n_stim]
+            category_idx.append(n_category)
+            stim_idx.append(n_stim)
+            filenames.append(filename)
+            cache_files.append(test_cache_file(filename, parameters) if parameters.cache_test_data else '')
+    dataset = tf.data.Dataset.from_tensor_slices((category_idx, stim_idx, filenames, cache_files))
+
+    # Read all test files in parallel, parse them and pass on their tags, so
+    # that all of them can be tested in a single prediction pass:
+    def tagged_test_dataset(category_idx, stim_idx, filename, cache_file):
+        dataset = test_dataset(filename, cache_file, parameters)
+        return dataset.map(lambda *data: (category_idx, stim_idx) + data)
+
+    dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            tagged_test_dataset, cycle_length=8, block_length=parameters.predict_batch_size))
+    dataset = dataset.batch(parameters.predict_batch_size)
+
+    # Use pipelining to speed up things (see https://www.youtube.com/watch?v=SxOsJPaxHME)
+    dataset = dataset.prefetch(2)
+
+    # Create an iterator for the dataset and the above modifications
+    iterator = dataset.make_one_shot_iterator()
+
+    # Get the next batch of images, labels and tags
+    [category_idx, stim_idx, shape_1_images, shape_2_images, shapelabels, nshapeslabels, vernierlabels,
+     x_shape_1, y_shape_1, x_shape_2, y_shape_2] = iterator.get_next()
+
+    feed_dict = {'shape_1_images': shape_1_images,
+                 'shape_2_images': shape_2_images,
+                 'shapelabels': shapelabels,
+                 'nshapeslabels': nshapeslabels,
+                 'vernier_offsets': vernierlabels,
+                 'x_shape_1': x_shape_1,
+                 'y_shape_1': y_shape_1,
+                 'x_shape_2': x_shape_2,
+                 'y_shape_2': y_shape_2,
+                 'category_idx': category_idx,
+                 'stim_idx': stim_idx,
+                 'mask_with_labels': False,
+                 'is_training': False}
+    return feed_dict, shapelabels
+
+
 
 ##############################
 #   Final input functions:   #
 ##############################
 def train_input_fn():
-    return input_fn(filenames=parameters.train_data_path, stage='train', parameters=parameters)
+    return input_fn(filenames=parameters.train_data_path, stage='train', parameters=parameters,
+                    buffer_size=parameters.buffer_size)
 
 def eval_input_fn(filename):
-    return input_fn(filenames=filename, stage='eval', parameters=parameters)
+    return input_fn(filenames=filename, stage='eval', parameters=parameters,
+                    buffer_size=parameters.buffer_size)
 
 def predict_input_fn(filenames):
     return input_fn(filenames=filenames, stage='test', parameters=parameters)
+
+def predict_crowding_input_fn(test_filenames):
+    return crowding_input_fn(test_filenames=test_filenames, parameters=parameters)
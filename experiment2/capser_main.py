@@ -15,14 +15,10 @@ import numpy as np
 import tensorflow as tf
 import os
 
-# Optional: use Beholder to check on weights during training in tensorboard
-from tensorboard.plugins.beholder import Beholder
-from tensorboard.plugins.beholder import BeholderHook
-
 from parameters import parameters
 from capser_model_fn import model_fn
-from capser_input_fn import train_input_fn, eval_input_fn, predict_input_fn
-from capser_functions import save_params, plot_uncrowding_results
+from capser_input_fn import train_input_fn, eval_input_fn, predict_crowding_input_fn
+from capser_functions import save_params, plot_uncrowding_results, group_crowding_predictions
 
 
 print('-------------------------------------------------------')
@@ -68,6 +64,10 @@ n_categories = len(parameters.test_crowding_data_paths)
 # Initialize results
 results = np.zeros(shape=(n_categories, n_idx, n_iterations))
 
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
 
 ###########################
 #       Main script:      #
@@ -81,12 +81,11 @@ for idx_execution in range(n_iterations):
     # Output the loss in the terminal every few steps:
     logging.getLogger().setLevel(logging.INFO)
 
-    # Optional: use Beholder to check on weights during training in tensorboard
-    beholder = Beholder(log_dir)
-    beholder_hook = BeholderHook(log_dir)
-
-    # Create the estimator (Retain the 2 most recent checkpoints)
-    checkpointing_config = tf.estimator.RunConfig(keep_checkpoint_max = 2)
+    # Create the estimator (Retain the 2 most recent checkpoints). Without
+    # summaries (see parameters.py: summary_level), the estimator does not
+    # save its default loss summaries either
+    save_summary_steps = None if parameters.summary_level == 'off' else 100
+    checkpointing_config = tf.estimator.RunConfig(keep_checkpoint_max=2, save_summary_steps=save_summary_steps)
 
     capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
                                     config=checkpointing_config,
@@ -109,6 +108,17 @@ for idx_execution in range(n_iterations):
         # Lets have less logs:
         logging.getLogger().setLevel(logging.CRITICAL)
 
+        # Lets get all the network performance results we need in a single
+        # prediction pass over all test files. The network returns the results
+        # after every routing iteration up to routing_max, which are grouped
+        # on the fly:
+        capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
+                                        params={'log_dir': log_dir,
+                                                'iter_routing': routing_max})
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy_iters, rank_pred_shapes_iters, rank_pred_proba_iters, n_samples = group_crowding_predictions(
+                capser_out, n_categories, n_idx, routing_max)
+
         # Testing for each chosen routing iteration (between routing_min and
         # routing_max) and each test stimulus category:
         for idx_routing in range(routing_min, routing_max+1):
@@ -116,6 +126,10 @@ for idx_execution in range(n_iterations):
             if not os.path.exists(log_dir_results):
                 os.mkdir(log_dir_results)
 
+            vernier_accuracy = vernier_accuracy_iters[idx_routing-1]
+            rank_pred_shapes = rank_pred_shapes_iters[idx_routing-1]
+            rank_pred_proba = rank_pred_proba_iters[idx_routing-1]
+
             cats = []
             res = []
             for n_category in range(n_categories):
@@ -125,28 +139,15 @@ for idx_execution in range(n_iterations):
                 print('-------------------------------------------------------')
                 print('Compute vernier offset for ' + category)
 
-                results0 = np.zeros(shape=(n_idx,))
+                results0 = vernier_accuracy[n_category, :]
                 for stim_idx in range(n_idx):
-                    # Load relevant tfrecord test stimulus file
-                    test_filename = category + '/' + str(stim_idx) + '.tfrecords'
-
-                    # Lets get all the network performance results we need:
-                    capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=log_dir,
-                                                    params={'log_dir': log_dir,
-                                                            'iter_routing': idx_routing})
-                    capser_out = list(capser.predict(lambda: predict_input_fn(test_filename)))
-                    vernier_accuracy = [p['vernier_accuracy'] for p in capser_out]
-                    rank_pred_shapes = [p['rank_pred_shapes'] for p in capser_out]
-                    rank_pred_proba = [p['rank_pred_proba'] for p in capser_out]
-
                     # Get all the results per round:
-                    results0[stim_idx] = np.mean(vernier_accuracy)
-                    results1 = np.unique(rank_pred_shapes)
-                    results2 = np.mean(rank_pred_proba, 0)
-                    res.append(np.mean(vernier_accuracy))
+                    results1 = rank_pred_shapes[n_category][stim_idx]
+                    results2 = rank_pred_proba[n_category, stim_idx, :]
+                    res.append(results0[stim_idx])
 
                     print('Finished calculations for stimulus type ' + str(stim_idx))
-                    print('Result: ' + str(results0[stim_idx]) + '; test_samples used: ' + str(len(vernier_accuracy)))
+                    print('Result: ' + str(results0[stim_idx]) + '; test_samples used: ' + str(int(n_samples[n_category, stim_idx])))
 
 
                     # Save ranking results (which shapes did the network recognize
@@ -47,14 +47,24 @@ def model_fn(features, labels, mode, params):
     
     # Plot each four (reconstructed) input images in tensorboard
     plot_n_images = 4
-    tf.summary.image('full_input_images', input_images, plot_n_images)
+    if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level == 'full':
+        tf.summary.image('full_input_images', input_images, plot_n_images)
 
 
-    # In case we provided a batch_size via params, use it
+    # The batch size is taken from the inputs, so that batches of any size
+    # can be used (e.g. the last, smaller batch of a test set)
+    batch_size = tf.shape(input_images)[0]
+    
+    # If we pass a parameter for getting reconstructions, use it, otherwise
+    # do not create reconstructions during testing
     try:
-        batch_size = params['batch_size']
+        get_reconstructions = params['get_reconstructions']
     except:
-        batch_size = parameters.batch_size
+        get_reconstructions = False
+
+    # In prediction mode, we only build the decoders if their outputs are
+    # requested. The reconstructions are opt-in via params:
+    build_decoders = mode != tf.estimator.ModeKeys.PREDICT or get_reconstructions
 
     # How many different shape types are expected in the image?
     if mode == tf.estimator.ModeKeys.PREDICT:
@@ -81,27 +91,54 @@ def model_fn(features, labels, mode, params):
     # Create convolutional layers and their output:
     conv_output, conv_output_sizes = conv_layers(input_images, parameters, is_training)
     
-    # Create primary caps and their output:
-    caps1_output = primary_caps_layer(conv_output, parameters)
+    # For inference, we can skip inactive primary capsules in the routing
+    # (see parameters.py: caps1_threshold):
+    if mode == tf.estimator.ModeKeys.PREDICT:
+        caps1_threshold = parameters.caps1_threshold
+    else:
+        caps1_threshold = 0.
     
-    # Create secondary caps and compute their output.
-    # Also, we need the individual outputs of the vernier caps and shape caps
-    caps2_output, caps2_output_norm = secondary_caps_layer(caps1_output, batch_size, iter_routing, parameters)
+    # The capsule layers (incl. routing) consist of many small ops, so we
+    # optionally compile them with XLA (see parameters.py: xla_caps):
+    with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=parameters.xla_caps):
+        # Create primary caps and their output:
+        caps1_output = primary_caps_layer(conv_output, parameters)
+        
+        # Create secondary caps and compute their output.
+        # Also, we need the individual outputs of the vernier caps and shape caps
+        caps2_output, caps2_output_norm, n_iter_routing, caps2_output_iters = secondary_caps_layer(
+                caps1_output, batch_size, iter_routing, parameters, caps1_threshold=caps1_threshold)
     shape_1_caps_activation = caps2_output[:, :, 0, :, :]
     shape_1_caps_activation = tf.expand_dims(shape_1_caps_activation, 2)
 
     # Compute vernier acuity based on the secondary vernier capsule outputs
     with tf.name_scope('1_vernier_acuity'):
-        vernierlabels_pred, vernieroffset_loss, vernieroffset_accuracy = compute_vernieroffset_loss(shape_1_caps_activation,
-                                                                                                    vernierlabels, parameters,
-                                                                                                    is_training)
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            # For predictions, we decode the vernier offsets after every routing
+            # iteration at once by stacking the iterations along the batch
+            # dimension. The last iteration gives the usual predictions:
+            shape_1_caps_activation_iters = tf.reshape(caps2_output_iters[:, :, :, 0, :, :],
+                                                       [-1, 1, 1, parameters.caps2_ndims, 1])
+            vernierlabels_pred_iters, vernieroffset_loss, _ = compute_vernieroffset_loss(shape_1_caps_activation_iters,
+                                                                                         tf.tile(vernierlabels, [iter_routing, 1]),
+                                                                                         parameters, is_training)
+            vernierlabels_pred_iters = tf.transpose(tf.reshape(vernierlabels_pred_iters, [iter_routing, -1]))
+            vernierlabels_pred = vernierlabels_pred_iters[:, -1]
+            vernieroffset_accuracy = tf.reduce_mean(tf.cast(tf.equal(vernierlabels_pred, vernierlabels[:, 0]), tf.float32))
+        
+        else:
+            vernierlabels_pred, vernieroffset_loss, vernieroffset_accuracy = compute_vernieroffset_loss(shape_1_caps_activation,
+                                                                                                        vernierlabels, parameters,
+                                                                                                        is_training)
         
         # Visualizations in tensorboard
         vernieroffset_loss = parameters.alpha_vernieroffset * vernieroffset_loss
-        tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
-        tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
-        tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
-        tf.summary.histogram('vernierlabels_real', vernierlabels)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level != 'off':
+            tf.summary.scalar('vernieroffset_loss', vernieroffset_loss)
+            tf.summary.scalar('vernieroffset_accuracy', vernieroffset_accuracy)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level == 'full':
+            tf.summary.histogram('vernierlabels_pred', vernierlabels_pred)
+            tf.summary.histogram('vernierlabels_real', vernierlabels)
     
     
     ##########################################
@@ -109,36 +146,60 @@ def model_fn(features, labels, mode, params):
     ##########################################
     # How many shapes have to be predicted? Predict them:
         with tf.name_scope('2_predict_shapes'):
-            shapelabels_pred = predict_shapelabels(caps2_output, n_shapes)[0]
+            # The predicted shapes are only needed for the decoders:
+            if build_decoders:
+                shapelabels_pred = predict_shapelabels(caps2_output, n_shapes)[0]
             
             # For prediction: give me a ranking of most probably shapes:
             rank_pred_shapes, rank_pred_proba = predict_shapelabels(caps2_output, len(parameters.shape_types))
+            
+            # And the same ranking after every routing iteration:
+            if mode == tf.estimator.ModeKeys.PREDICT:
+                caps2_output_iters_flat = tf.reshape(caps2_output_iters, [-1, 1, parameters.caps2_ncaps,
+                                                                          parameters.caps2_ndims, 1])
+                rank_pred_shapes_iters, rank_pred_proba_iters = predict_shapelabels(caps2_output_iters_flat,
+                                                                                    len(parameters.shape_types))
+                rank_pred_shapes_iters = tf.transpose(tf.reshape(rank_pred_shapes_iters,
+                                                                 [iter_routing, -1, len(parameters.shape_types)]), [1, 0, 2])
+                rank_pred_proba_iters = tf.transpose(tf.reshape(rank_pred_proba_iters,
+                                                                [iter_routing, -1, len(parameters.shape_types)]), [1, 0, 2])
     
     
     ##########################################
     #     Create masked decoder input        #
     ##########################################
     with tf.name_scope('3_Masked_decoder_input'):
-        if n_shapes==2:
-            shape_1_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels[:, 0], shapelabels_pred[:, 0], caps2_output, parameters)
-            shape_2_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 1], caps2_output, parameters)
+        if build_decoders:
+            if n_shapes==2:
+                shape_1_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels[:, 0], shapelabels_pred[:, 0], caps2_output, parameters)
+                shape_2_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels[:, 1], shapelabels_pred[:, 1], caps2_output, parameters)
             
-        elif n_shapes==1:
-            shape_1_decoder_input = create_masked_decoder_input(
-                    mask_with_labels, shapelabels, shapelabels_pred, caps2_output, parameters)
+            elif n_shapes==1:
+                shape_1_decoder_input = create_masked_decoder_input(
+                        mask_with_labels, shapelabels, shapelabels_pred, caps2_output, parameters)
 
 
     ##########################################
     #         Decode reconstruction          #
     ##########################################
     with tf.name_scope('4_Reconstruction_loss'):
-        if parameters.decode_reconstruction:
+        if parameters.decode_reconstruction and build_decoders:
             if n_shapes==2:
-                # Create decoder outputs for shape_1 and shape_2 images
-                shape_1_output_reconstructed = compute_reconstruction(shape_1_decoder_input, parameters, is_training, conv_output_sizes)
-                shape_2_output_reconstructed = compute_reconstruction(shape_2_decoder_input, parameters, is_training, conv_output_sizes)
+                # Create decoder outputs for shape_1 and shape_2 images:
+                decoder_inputs = [shape_1_decoder_input, shape_2_decoder_input]
+                if parameters.batch_norm_reconstruction:
+                    # Batch normalization statistics are computed per shape
+                    output_reconstructed = [compute_reconstruction(decoder_input, parameters, is_training, conv_output_sizes)
+                                            for decoder_input in decoder_inputs]
+                else:
+                    # Decode all shapes in a single pass by stacking the decoder
+                    # inputs along the batch dimension:
+                    output_reconstructed = compute_reconstruction(tf.concat(decoder_inputs, axis=0), parameters,
+                                                                  is_training, conv_output_sizes)
+                    output_reconstructed = tf.split(output_reconstructed, len(decoder_inputs), axis=0)
+                shape_1_output_reconstructed, shape_2_output_reconstructed = output_reconstructed[:2]
                 
                 shape_1_img_reconstructed = tf.reshape(
                         shape_1_output_reconstructed,
@@ -149,18 +210,19 @@ def model_fn(features, labels, mode, params):
                         [batch_size, parameters.im_size[0], parameters.im_size[1], parameters.im_depth],
                         name='shape_2_img_reconstructed')
 
-                # Create an rgb tf.summary image for tensorboard
-                color_masks = tf.cast(tf.convert_to_tensor([[121, 199, 83],  # 0: vernier, green
-                                                            [220, 76, 70],   # 1: red
-                                                            [79, 132, 196]]), tf.float32)  # 3: blue
-                color_masks = tf.expand_dims(color_masks, axis=1)
-                color_masks = tf.expand_dims(color_masks, axis=1)
-                decoder_output_images_rgb_0 = tf.image.grayscale_to_rgb(shape_1_img_reconstructed) * color_masks[0, :, :, :]
-                decoder_output_images_rgb_1 = tf.image.grayscale_to_rgb(shape_2_img_reconstructed) * color_masks[1, :, :, :]
+                # Create an rgb tf.summary image for tensorboard (only built, if it is
+                # visualized, see parameters.py: summary_level)
+                if parameters.summary_level == 'full':
+                    color_masks = tf.cast(tf.convert_to_tensor([[121, 199, 83],  # 0: vernier, green
+                                                                [220, 76, 70],   # 1: red
+                                                                [79, 132, 196]]), tf.float32)  # 3: blue
+                    color_masks = tf.expand_dims(color_masks, axis=1)
+                    color_masks = tf.expand_dims(color_masks, axis=1)
+                    decoder_output_images_rgb_0 = tf.image.grayscale_to_rgb(shape_1_img_reconstructed) * color_masks[0, :, :, :]
+                    decoder_output_images_rgb_1 = tf.image.grayscale_to_rgb(shape_2_img_reconstructed) * color_masks[1, :, :, :]
 
-                # Visualizations in tensorboard
-                decoder_output_img = decoder_output_images_rgb_0 + decoder_output_images_rgb_1
-                tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
+                    decoder_output_img = decoder_output_images_rgb_0 + decoder_output_images_rgb_1
+                    tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
                 
                 # Calculate reconstruction loss for shape_1 and shape_2 images batch
                 shape_1_reconstruction_loss = compute_reconstruction_loss(shape_1_images, shape_1_output_reconstructed, parameters)
@@ -181,7 +243,8 @@ def model_fn(features, labels, mode, params):
                         name='shape_1_img_reconstructed')
     
                 # Visualizations in tensorboard
-                tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
+                if parameters.summary_level == 'full':
+                    tf.summary.image('decoder_output_img', decoder_output_img, plot_n_images)
                 
                 # Calculate reconstruction loss for shape_1 images
                 shape_1_reconstruction_loss = compute_reconstruction_loss(shape_1_images, shape_1_output_reconstructed, parameters)
@@ -196,9 +259,10 @@ def model_fn(features, labels, mode, params):
             reconstruction_loss = 0.
 
         # Visualizations in tensorboard
-        tf.summary.scalar('shape_1_reconstruction_loss', shape_1_reconstruction_loss)
-        tf.summary.scalar('shape_2_reconstruction_loss', shape_2_reconstruction_loss)
-        tf.summary.scalar('reconstruction_loss', reconstruction_loss)
+        if mode != tf.estimator.ModeKeys.PREDICT and parameters.summary_level != 'off':
+            tf.summary.scalar('shape_1_reconstruction_loss', shape_1_reconstruction_loss)
+            tf.summary.scalar('shape_2_reconstruction_loss', shape_2_reconstruction_loss)
+            tf.summary.scalar('reconstruction_loss', reconstruction_loss)
     
     
     ##########################################
@@ -209,9 +273,26 @@ def model_fn(features, labels, mode, params):
         # If in prediction-mode use (one of) the following for predictions:
         # Since accuracy is calculated over whole batch, we have to repeat it
         # batch_size times (coz all prediction vectors must be same length)
-        predictions = {'vernier_accuracy': tf.ones(shape=batch_size) * vernieroffset_accuracy,
+        predictions = {'vernier_accuracy': tf.ones(shape=[batch_size]) * vernieroffset_accuracy,
+                       'vernier_correct': tf.cast(tf.equal(vernierlabels_pred, vernierlabels[:, 0]), tf.float32),
                        'rank_pred_shapes': rank_pred_shapes,
-                       'rank_pred_proba': rank_pred_proba}
+                       'rank_pred_proba': rank_pred_proba,
+                       'n_iter_routing': n_iter_routing,
+                       # Results after each routing iteration (second dimension):
+                       'vernier_correct_iters': tf.cast(tf.equal(vernierlabels_pred_iters, vernierlabels), tf.float32),
+                       'rank_pred_shapes_iters': rank_pred_shapes_iters,
+                       'rank_pred_proba_iters': rank_pred_proba_iters}
+        
+        # Reconstructions are only returned if requested via params:
+        if get_reconstructions:
+            predictions['decoder_output_img1'] = shape_1_img_reconstructed
+            predictions['decoder_output_img2'] = shape_2_img_reconstructed
+
+        # Pass on the tags of the test files, if all test files are tested in
+        # a single prediction pass (see crowding_input_fn in capser_input_fn.py)
+        if 'category_idx' in features:
+            predictions['category_idx'] = features['category_idx']
+            predictions['stim_idx'] = features['stim_idx']
         
         spec = tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
 
@@ -229,14 +310,16 @@ def model_fn(features, labels, mode, params):
             accuracy = compute_accuracy(shapelabels, shapelabels_pred)
             
             # Visualizations in tensorboard
-            tf.summary.scalar('margin_accuracy', accuracy)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('margin_accuracy', accuracy)
 
             # Define the loss-function to be optimized
             margin_loss = compute_margin_loss(caps2_output_norm, shapelabels, parameters)
             margin_loss = parameters.alpha_margin * margin_loss
             
             # Visualizations in tensorboard
-            tf.summary.scalar('margin_loss', margin_loss)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('margin_loss', margin_loss)
     
 
     ##########################################
@@ -248,8 +331,9 @@ def model_fn(features, labels, mode, params):
             nshapes_accuracy = 0.
                 
             # Visualizations in tensorboard
-            tf.summary.scalar('nshapes_loss', nshapes_loss)
-            tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('nshapes_loss', nshapes_loss)
+                tf.summary.scalar('nshapes_accuracy', nshapes_accuracy)
 
 
     ##########################################
@@ -264,11 +348,12 @@ def model_fn(features, labels, mode, params):
             location_loss = 0.
             
             # Visualizations in tensorboard
-            tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
-            tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
-            tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
-            tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
-            tf.summary.scalar('location_loss', location_loss)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('x_shape_1_loss', x_shape_1_loss)
+                tf.summary.scalar('y_shape_1_loss', y_shape_1_loss)
+                tf.summary.scalar('x_shape_2_loss', x_shape_2_loss)
+                tf.summary.scalar('y_shape_2_loss', y_shape_2_loss)
+                tf.summary.scalar('location_loss', location_loss)
 
 
     ##########################################
@@ -297,12 +382,17 @@ def model_fn(features, labels, mode, params):
             train_op = optimizer.minimize(loss=final_loss, global_step=tf.train.get_global_step(), name='train_op')
             
             # Visualizations in tensorboard
-            tf.summary.scalar('learning_rate', learning_rate)
+            if parameters.summary_level != 'off':
+                tf.summary.scalar('learning_rate', learning_rate)
         
         # Write summaries during evaluation
-        eval_summary_hook = tf.train.SummarySaverHook(save_steps=100,
-                                                      output_dir=log_dir + '/eval',
-                                                      summary_op=tf.summary.merge_all())
+        # (if no summaries are built, there is nothing to write)
+        if parameters.summary_level != 'off':
+            evaluation_hooks = [tf.train.SummarySaverHook(save_steps=100,
+                                                          output_dir=log_dir + '/eval',
+                                                          summary_op=tf.summary.merge_all())]
+        else:
+            evaluation_hooks = []
         
         # Wrap all of this in an EstimatorSpec.
         spec = tf.estimator.EstimatorSpec(
@@ -310,6 +400,6 @@ def model_fn(features, labels, mode, params):
             loss=final_loss,
             train_op=train_op,
             eval_metric_ops={},
-            evaluation_hooks=[eval_summary_hook])
+            evaluation_hooks=evaluation_hooks)
     
     return spec
@@ -0,0 +1,91 @@
+"""
+Capsule Networks as Recurrent Models of Grouping and Segmentation
+
+Experiment 2: The role of recurrent processing
+
+This script fake-quantizes the conv layers, the transformation matrices W of
+the secondary capsules and the decoders of the trained networks to int8 after
+training (see fake_quantize_checkpoint in capser_functions.py), while the
+routing stays in float. The fake-quantized networks still run with float32
+weights and kernels, so this is a study of the accuracy cost and the storage
+of int8 weights, not of the inference speed. It reports the size of the
+weights and the deviation of the vernier accuracies from the float networks
+for each test condition.
+The networks have to be trained first (see capser_main.py).
+
+@author: Lynn Schmittwilken
+"""
+
+import logging
+import numpy as np
+import tensorflow as tf
+
+from parameters import parameters
+from capser_model_fn import model_fn
+from capser_input_fn import predict_crowding_input_fn
+from capser_functions import group_crowding_predictions, fake_quantize_checkpoint
+
+
+print('-------------------------------------------------------')
+print('TF version:', tf.__version__)
+print('Starting int8 fake quantization report...')
+print('-------------------------------------------------------')
+
+
+###########################
+#      Preparations:      #
+###########################
+n_iterations = parameters.n_iterations
+n_idx = parameters.n_idx
+n_categories = len(parameters.test_crowding_data_paths)
+
+# All test files, which are tested in a single prediction pass:
+test_filenames = [[category + '/' + str(stim_idx) + '.tfrecords' for stim_idx in range(n_idx)]
+                  for category in parameters.test_crowding_data_paths]
+
+# Initialize results (0: float, 1: fake-quantized int8)
+results = np.zeros(shape=(2, n_categories, n_idx, n_iterations))
+n_bytes = np.zeros(shape=(2, n_iterations))
+
+# Lets have less logs:
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+###########################
+#       Main script:      #
+###########################
+for idx_execution in range(n_iterations):
+    log_dir = parameters.logdir + str(idx_execution) + '/'
+    fake_quant_dir = log_dir + 'fake_quant_int8/'
+    n_bytes[:, idx_execution] = fake_quantize_checkpoint(tf.train.latest_checkpoint(log_dir), fake_quant_dir)
+
+    for idx_model, model_dir in enumerate([log_dir, fake_quant_dir]):
+        capser = tf.estimator.Estimator(model_fn=model_fn, model_dir=model_dir,
+                                        params={'log_dir': log_dir,
+                                                'iter_routing': parameters.train_iter_routing})
+
+        capser_out = capser.predict(lambda: predict_crowding_input_fn(test_filenames))
+        vernier_accuracy, _, _, _ = group_crowding_predictions(capser_out, n_categories, n_idx)
+        results[idx_model, :, :, idx_execution] = vernier_accuracy
+
+
+# Compare the fake-quantized to the float networks:
+mean_results = np.mean(results, axis=-1)
+deviation = np.mean(results[1] - results[0], axis=-1)
+txt_file_name = parameters.logdir + '/fake_quant_report.txt'
+with open(txt_file_name, 'w') as f:
+    report = ('weights: %.1fkB (float32), %.1fkB (int8); mean abs deviation: %.4f; max abs deviation: %.4f\n'
+              % (np.mean(n_bytes[0]) / 1024., np.mean(n_bytes[1]) / 1024., np.mean(np.abs(deviation)),
+                 np.max(np.abs(deviation))))
+    for n_category in range(n_categories):
+        category = parameters.test_crowding_data_paths[n_category]
+        report += category + ' : \t' + str(mean_results[0, n_category, :]) + \
+        ' : \t' + str(mean_results[1, n_category, :]) + ' : \t' + str(deviation[n_category, :]) + '\n'
+
+    print('-------------------------------------------------------')
+    print(report)
+    f.write(report + '\n')
+
+
+print('... Finished int8 fake quantization report!')
+print('-------------------------------------------------------')
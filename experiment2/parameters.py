@@ -22,7 +22,10 @@ flags.DEFINE_string('data_path', data_path, 'path where all data files are locat
 flags.DEFINE_string('logdir', data_path + '/' + MODEL_NAME + '/', 'save the model results here')
 
 # Training data set involving all shape defined in shape_types:
-flags.DEFINE_string('train_data_path', data_path+'/train.tfrecords', 'path for tfrecords with training set')
+# The training set is split into n_train_shards files which are read in parallel.
+# The * in train_data_path gets replaced by the shard number:
+flags.DEFINE_string('train_data_path', data_path+'/train_*.tfrecords', 'path (or glob) for tfrecords with training set')
+flags.DEFINE_integer('n_train_shards', 10, 'number of shards for the training set')
 
 # Validation data set involving all shape defined in shape_types:
 flags.DEFINE_string('val_data_path', data_path+'/val.tfrecords', 'path for tfrecords with validation set')
@@ -101,6 +104,11 @@ flags.DEFINE_list('test_configs', [test_configs], 'pool of shapes (see batchmake
 ###########################
 flags.DEFINE_list('train_noise', [0.0, 0.02], 'amount of added random Gaussian noise')
 flags.DEFINE_list('test_noise', [0.1, 0.12], 'amount of added random Gaussian noise')
+flags.DEFINE_integer('test_noise_seed', 42, 'seed for the stateless test noise (same seed = same noisy test stimuli)')
+flags.DEFINE_boolean('cache_test_data', False, 'if true, cache the noisy test stimuli next to the test tfrecords files')
+flags.DEFINE_boolean('noise_bank', False, 'if true, serve the noise from a precomputed noise bank (faster)')
+flags.DEFINE_integer('noise_bank_size', 1000, 'number of noise fields (=images) in the noise bank')
+flags.DEFINE_integer('noise_bank_seed', 42, 'seed for drawing the noise bank (same seed = same noise bank)')
 flags.DEFINE_list('clip_values', [0., 1.], 'min and max pixel value for every image')
 flags.DEFINE_boolean('allow_contrast_augmentation', True, 'augment by changing contrast and brightness')
 flags.DEFINE_float('delta_brightness', 0.1, 'factor to adjust brightness (+/-), must be non-negative')
@@ -134,6 +142,7 @@ flags.DEFINE_list('conv_params', [conv1_params, conv2_params, conv3_params], 'li
 
 flags.DEFINE_integer('caps1_nmaps', caps1_nmaps, 'primary caps, number of feature maps')
 flags.DEFINE_integer('caps1_ncaps', caps1_nmaps * dim1 * dim2, 'primary caps, number of caps')
+flags.DEFINE_list('caps1_grid', [dim1, dim2], 'primary caps, number of positions along both image dimensions')
 flags.DEFINE_integer('caps1_ndims', caps1_ndims, 'primary caps, number of dims')
 
 
@@ -154,6 +163,7 @@ flags.DEFINE_integer('n_output', im_size[0]*im_size[1], 'output size of the deco
 ###########################
 # For training
 flags.DEFINE_integer('batch_size', 48, 'batch size')
+flags.DEFINE_integer('predict_batch_size', 480, 'batch size for predictions (the last batch can be smaller)')
 flags.DEFINE_float('learning_rate', 0.0004, 'chosen learning rate for training')
 flags.DEFINE_float('learning_rate_decay_steps', 500, 'decay for cosine decay restart')
 
@@ -162,13 +172,27 @@ flags.DEFINE_integer('n_steps', 4500, 'number of steps')
 flags.DEFINE_integer('n_rounds', 1, 'number of evaluations; full training steps is equal to n_steps times this number')
 flags.DEFINE_integer('n_iterations', 50, 'number of trained networks')
 
-flags.DEFINE_integer('buffer_size', 1024, 'buffer size')
+flags.DEFINE_integer('buffer_size', 256, 'buffer size for shuffling the samples (in addition to shuffling the shards)')
+flags.DEFINE_integer('shard_seed', 42, 'seed for the shard permutation in each epoch')
 flags.DEFINE_integer('eval_steps', 50, 'frequency for eval spec; u need at least eval_steps*batch_size stimuli in the validation set')
 flags.DEFINE_integer('eval_throttle_secs', 150, 'minimal seconds between evaluation passes')
+flags.DEFINE_enum('summary_level', 'full', ['off', 'scalars', 'full'], 'tensorboard summaries: off, scalars (losses/accuracies) or full (incl. histograms and images)')
 flags.DEFINE_integer('train_iter_routing', 8, 'number of iterations in routing algorithm during training')
 flags.DEFINE_integer('routing_min', 1, 'min number of iterations in routing algorithm during testing')
 flags.DEFINE_integer('routing_max', 8, 'max number of iterations in routing algorithm during testing')
+flags.DEFINE_boolean('adaptive_routing', False, 'if true, stop routing for each sample once its caps2 outputs converged')
+flags.DEFINE_float('routing_tolerance', 1e-3, 'adaptive routing: max change of the caps2 outputs below which routing stops')
+flags.DEFINE_integer('routing_top_k', 0, 'if >0, each primary caps only routes to its k secondary caps with the largest predictions')
+flags.DEFINE_float('caps1_threshold', 0., 'for inference: if >0, primary caps with smaller output norms are skipped in the routing')
+flags.DEFINE_boolean('routing_stop_gradient', False, 'if true, gradients only flow through the final routing iteration')
+flags.DEFINE_boolean('routing_recompute', False, 'if true, only store the loop variables of each routing iteration and recompute the rest during backprop (saves memory)')
+flags.DEFINE_integer('routing_chunk_size', 0, 'if >0, route the primary caps in chunks of this size (bounds the memory)')
 flags.DEFINE_float('init_sigma', 0.01, 'stddev for W initializer')
+flags.DEFINE_boolean('share_W', False, 'if true, share W across all positions of each primary caps map')
+flags.DEFINE_boolean('conv_caps', False, 'if true, route the secondary caps convolutionally from local windows of primary caps (shared W, not with caps1_threshold)')
+flags.DEFINE_integer('conv_caps_kernel', 3, 'conv_caps: size of the windows (in primary caps positions)')
+flags.DEFINE_integer('conv_caps_stride', 2, 'conv_caps: stride of the windows (in primary caps positions)')
+flags.DEFINE_boolean('xla_caps', False, 'if true, compile the capsule layers (incl. routing) with XLA')
 
 
 ###########################